@@ -14,23 +14,30 @@
 import os
 import re
 import cmd
+import json
+import time
 import random
+import hashlib
+import tarfile
+import functools
+import threading
+import tracemalloc
+import urllib.request
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-
-#@title Figure settings
-# %matplotlib inline
-# %config InlineBackend.figure_format = 'retina'
-plt.style.use("https://raw.githubusercontent.com/NeuromatchAcademy/course-content/master/nma.mplstyle")
 
 ## Basic parameters
 
 # Load HCP parcellated task data
 
-HCP_DIR = "./hcp"
-if not os.path.isdir(HCP_DIR):
-  os.mkdir(HCP_DIR)
+# Local paths can be configured through environment variables, so that nodes
+# without network access can point to artifacts that are already present
+HCP_DIR = os.environ.get("HCP_DIR", "./hcp")
+
+# If set, never download: missing artifacts raise FileNotFoundError instead
+HCP_OFFLINE = os.environ.get("HCP_OFFLINE", "") not in ("", "0")
 
 # The data have already been aggregated into ROIs from the Glasser parcellation
 N_PARCELS = 360
@@ -48,6 +55,26 @@ N_RUNS = 2
 # The dataset for the SOCIAL experiment also includes mental_resp and other_resp
 CONDITIONS = ['mental','rnd']
 
+# Precision of the timeseries and of everything computed from them. float32
+# halves the memory and bandwidth of the cohort; means that need it are still
+# accumulated in float64 (see validate_precision)
+DTYPE = np.dtype(os.environ.get("HCP_DTYPE", "float64"))
+
+# Workers used to load the cohort in parallel (None or 1 keeps the serial loop)
+N_WORKERS = None
+
+# Per-stage profiling (timers, memory and counters, see profile_report). Off
+# unless HCP_PROFILE is set; HCP_PROFILE_MEMORY=0 keeps the timers and counters
+# but skips tracemalloc, which slows down every allocation while it runs.
+PROFILE        = os.environ.get("HCP_PROFILE", "") not in ("", "0")
+PROFILE_MEMORY = os.environ.get("HCP_PROFILE_MEMORY", "1") not in ("", "0")
+PROFILE_REPORT = os.environ.get("HCP_PROFILE_REPORT")
+
+# Feature matrices are cached on disk; least recently used ones are evicted
+# once the cache grows beyond FEATURE_CACHE_SIZE bytes
+FEATURE_CACHE_DIR  = f"{HCP_DIR}/cache"
+FEATURE_CACHE_SIZE = 2 * 1024**3
+
 # All these names are needed to get the right index for the timeseries.
 BOLD_NAMES = [
   "rfMRI_REST1_LR", "rfMRI_REST1_RL",
@@ -63,10 +90,10 @@ BOLD_NAMES = [
 
 # Downloading data
 
-fname = "hcp_task.tgz"
-if not os.path.exists(fname):
-  !wget -qO $fname https://osf.io/s4h8j/download/
-  !tar -xzf $fname -C $HCP_DIR --strip-components=1
+# Nothing is downloaded at import time: ensure_dataset() fetches the archive
+HCP_TASK_URL  = "https://osf.io/s4h8j/download/"
+ATLAS_URL     = "https://osf.io/j5kuc/download"
+NMA_STYLE_URL = "https://raw.githubusercontent.com/NeuromatchAcademy/course-content/master/nma.mplstyle"
 
 #List with IDs for the 339 subjects
 
@@ -114,56 +141,420 @@ subjects_str = re.findall(r"[\w']+", str_ids_339)
 SUBJECTS   = [int(i) for i in subjects_str]
 N_SUBJECTS = len(SUBJECTS)
 
+# Subject's ID -> index in the NMA-curated dataset (and row of SUBJECTS_BEHAVIOR)
+SUBJECT_INDEX = {subject_id: i for i, subject_id in enumerate(SUBJECTS)}
+
 # Loading subjects's behavior information
 
 # Retrieved from http://www.humanconnectomeproject.org/ and uploaded to a public repository for easy access.
-url = "https://raw.githubusercontent.com/Luevateros/neuromatch_neuroscience/main/projects/resources/Demographics_HCP_7_7_2021_0_3_48.csv"
-all_subjects = pd.read_csv(url)
+BEHAVIOR_URL = "https://raw.githubusercontent.com/Luevateros/neuromatch_neuroscience/main/projects/resources/Demographics_HCP_7_7_2021_0_3_48.csv"
+
+# Loading region information
+#This dataset contains region name and network assignment for each parcel.
+#Detailed information about the name used for each region is provided [in the Supplement]
+#(https://static-content.springer.com/esm/art%3A10.1038%2Fnature18933/MediaObjects/41586_2016_BFnature18933_MOESM330_ESM.pdf) to [Glasser et al. 2016](https://www.nature.com/articles/nature18933).
+#Information about the network parcellation is provided in [Ji et al, 2019](https://www.ncbi.nlm.nih.gov/pmc/articles/PMC6289683/).
+
+# Artifacts resolved by resolve_data: URL, local path and expected SHA-256
+# (None skips the check). Paths and checksums can be set through the environment.
+DATA_SOURCES = {
+    'hcp_task' : dict(url=HCP_TASK_URL,
+                      path=os.environ.get("HCP_TASK_ARCHIVE", "hcp_task.tgz"),
+                      sha256=os.environ.get("HCP_TASK_SHA256")),
+    'atlas'    : dict(url=ATLAS_URL,
+                      path=os.environ.get("HCP_ATLAS", f"{HCP_DIR}/atlas.npz"),
+                      sha256=os.environ.get("HCP_ATLAS_SHA256")),
+    'behavior' : dict(url=BEHAVIOR_URL,
+                      path=os.environ.get("HCP_BEHAVIOR", f"{HCP_DIR}/Demographics_HCP_7_7_2021_0_3_48.csv"),
+                      sha256=os.environ.get("HCP_BEHAVIOR_SHA256")),
+    'mplstyle' : dict(url=NMA_STYLE_URL,
+                      path=os.environ.get("NMA_STYLE", f"{HCP_DIR}/nma.mplstyle"),
+                      sha256=None),
+}
+
+# Lazily initialised globals: SUBJECTS_BEHAVIOR, features, region_info, NETWORKS
+# and ROIs are built on first access, through the loader functions below.
+_SUBJECTS_BEHAVIOR = None
+_REGION_INFO       = None
+_NETWORK_INDEX     = None
+
+# Profiling
+
+# Per stage: calls, seconds, peak traced bytes and peak RSS. Counters: files
+# opened, bytes read, frames selected, subjects processed...
+_PROFILE_STAGES   = {}
+_PROFILE_COUNTERS = {}
+_PROFILE_LOCK     = threading.Lock()
+_PROFILE_STACK    = threading.local()
+
+#Function: Peak resident set size of the process, in bytes
+
+def peak_rss():
+  try:
+    import resource
+  except ImportError:  # Not available on Windows
+    return None
+  # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+  scale = 1 if os.uname().sysname == 'Darwin' else 1024
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+#Function: Add to a profiling counter
+
+def count(name, n=1):
+  if PROFILE:
+    with _PROFILE_LOCK:
+      _PROFILE_COUNTERS[name] = _PROFILE_COUNTERS.get(name, 0) + n
+
+#Function: Record a function as a pipeline stage
+
+def profile_stage(func):
+  """
+  Decorator recording the calls, wall time, peak traced memory (tracemalloc,
+  NumPy allocations included) and peak RSS of a pipeline stage. Times of
+  nested stages are included in the outer ones.
+
+  When PROFILE is off, a call costs one extra global lookup. Work done in
+  process pools is timed, but its counters stay in the worker processes.
+  """
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    if not PROFILE:
+      return func(*args, **kwargs)
+
+    # Peaks seen by the open stages of this thread: nested stages reset the
+    # tracemalloc peak, so each one hands its own peak back to its parent
+    stack = _PROFILE_STACK.__dict__.setdefault('peaks', [])
+    trace = PROFILE_MEMORY and threading.current_thread() is threading.main_thread()
+    started = trace and not tracemalloc.is_tracing()
+    if started:
+      tracemalloc.start()
+    if trace:
+      start_bytes, peak = tracemalloc.get_traced_memory()
+      if stack:
+        stack[-1] = max(stack[-1], peak)
+      tracemalloc.reset_peak()
+      stack.append(0)
+
+    tic = time.perf_counter()
+    try:
+      return func(*args, **kwargs)
+    finally:
+      seconds = time.perf_counter() - tic
+      peak = None
+      if trace:
+        peak = max(tracemalloc.get_traced_memory()[1], stack.pop())
+        if stack:
+          stack[-1] = max(stack[-1], peak)
+        if started:
+          tracemalloc.stop()
+        peak -= start_bytes
+      record_stage(func.__name__, seconds, peak)
+
+  return wrapper
+
+#Function: Add one call to the record of a stage
+
+def record_stage(name, seconds, peak_bytes=None):
+  rss = peak_rss()
+  with _PROFILE_LOCK:
+    stage = _PROFILE_STAGES.setdefault(name, {'calls': 0, 'seconds': 0.0,
+                                              'peak_bytes': None, 'peak_rss': None})
+    stage['calls']   += 1
+    stage['seconds'] += seconds
+    if peak_bytes is not None:
+      stage['peak_bytes'] = max(stage['peak_bytes'] or 0, peak_bytes)
+    if rss is not None:
+      stage['peak_rss'] = max(stage['peak_rss'] or 0, rss)
+
+#Function: Forget the stages and counters recorded so far
+
+def reset_profile():
+  with _PROFILE_LOCK:
+    _PROFILE_STAGES.clear()
+    _PROFILE_COUNTERS.clear()
+
+#Function: Report of the stages and counters recorded so far
+
+def profile_report(path=None):
+  """
+  Report of the profiled stages and counters, optionally written as JSON.
+
+  Args:
+    path (None or str) : If set, the report is also written there
 
-# Retrieve only the subjects of interest
-unsorted_subjects = all_subjects.loc[all_subjects['Subject'].isin(subjects_str)]
+  Returns:
+    report (dict): {'stages': {name: {calls, seconds, peak_bytes, peak_rss}},
+      'counters': {name: value}, 'peak_rss': bytes}
+  """
+  with _PROFILE_LOCK:
+    report = {'stages':   {name: dict(stage) for name, stage in _PROFILE_STAGES.items()},
+              'counters': dict(_PROFILE_COUNTERS),
+              'peak_rss': peak_rss()}
+  if path is not None:
+    with open(path, 'w') as f:
+      json.dump(report, f, indent=2)
+  return report
+
+#Function: Print the profiled stages as a table, slowest first
+
+def print_profile():
+  report = profile_report()
+  if report['stages']:
+    table = pd.DataFrame.from_dict(report['stages'], orient='index')
+    table['peak_MiB'] = table['peak_bytes'].astype(float) / 1024**2
+    table['rss_MiB']  = table['peak_rss'].astype(float) / 1024**2
+    table = table[['calls', 'seconds', 'peak_MiB', 'rss_MiB']]
+    print(table.sort_values('seconds', ascending=False).round(3).to_string())
+  for name, value in sorted(report['counters'].items()):
+    print(f"{name:<20} {value}")
+
+# Dataset loaders
+
+#Function: Download a file unless it already exists
+
+@profile_stage
+def download_file(url, fname):
+  if not os.path.exists(fname):
+    # Download next to the target and rename, so partial files are never used
+    urllib.request.urlretrieve(url, f"{fname}.part")
+    os.replace(f"{fname}.part", fname)
+    count('files_downloaded')
+    count('bytes_downloaded', os.path.getsize(fname))
+  return fname
+
+#Function: Get the SHA-256 of a file, reusing the last result if it is unchanged
+
+def file_sha256(fname):
+  """
+  Get the SHA-256 of a file. The digest is memoised next to the file
+  (fname.sha256) with its size and mtime, so unchanged files are not
+  hashed again.
 
+  Args:
+    fname (str) : Path of the file
 
-subjects_in_order = []
-# Subjects in the same order as in ids
-for id in SUBJECTS:
-  subjects_in_order.append(unsorted_subjects.loc[unsorted_subjects['Subject'] == id])
+  Returns:
+    digest (str): Hexadecimal SHA-256
+  """
+  stat  = os.stat(fname)
+  memo  = f"{fname}.sha256"
+  state = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
 
-# The subjects of interest are in the same order as in the NMA-curated dataset
-SUBJECTS_BEHAVIOR = pd.concat(subjects_in_order, keys=list(range(N_SUBJECTS+1)))
+  if os.path.exists(memo):
+    with open(memo) as f:
+      saved = json.load(f)
+    if saved.get('size') == state['size'] and saved.get('mtime_ns') == state['mtime_ns']:
+      return saved['sha256']
 
-# Remove index column that remained from the original dataframe
-SUBJECTS_BEHAVIOR.index = SUBJECTS_BEHAVIOR.index.droplevel(-1)
+  digest = hashlib.sha256()
+  with open(fname, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      digest.update(chunk)
+  state['sha256'] = digest.hexdigest()
 
-# Find columns with NaN values
-columns_with_nans = []
-for column, columnData in SUBJECTS_BEHAVIOR.iteritems():
-  if SUBJECTS_BEHAVIOR[column].isnull().values.any():
-    columns_with_nans.append(column)
+  try:
+    with open(memo, 'w') as f:
+      json.dump(state, f)
+  except OSError:
+    pass  # Read-only location: the digest is simply recomputed next time
 
-# Remove columns with NaN values (before 582, after 489 columns)
-for column in columns_with_nans:
-  del(SUBJECTS_BEHAVIOR[column])
+  return state['sha256']
 
-# See all the features available in SUBJECTS_BEHAVIOR
-features = list(SUBJECTS_BEHAVIOR.columns)
-# cmd.Cmd().columnize(features, displaywidth=80)  # <-- Uncomment to see all features !!!
+#Function: Resolve a data artifact to a verified local path
 
-# Loading region information
-#This dataset contains region name and network assignment for each parcel.
-#Detailed information about the name used for each region is provided [in the Supplement]
-#(https://static-content.springer.com/esm/art%3A10.1038%2Fnature18933/MediaObjects/41586_2016_BFnature18933_MOESM330_ESM.pdf) to [Glasser et al. 2016](https://www.nature.com/articles/nature18933).
-#Information about the network parcellation is provided in [Ji et al, 2019](https://www.ncbi.nlm.nih.gov/pmc/articles/PMC6289683/).
+def resolve_data(name):
+  """
+  Resolve a data artifact to a local path. It is downloaded only when missing,
+  never if HCP_OFFLINE is set, and its checksum is verified when one is known.
+
+  Args:
+    name (str) : Key of DATA_SOURCES
+
+  Returns:
+    path (str): Local path of the artifact
+
+  Raises:
+    FileNotFoundError if the artifact is missing and HCP_OFFLINE is set.
+    ValueError if the checksum does not match.
+  """
+  source = DATA_SOURCES[name]
+  path   = source['path']
+
+  if not os.path.exists(path):
+    if HCP_OFFLINE:
+      raise FileNotFoundError(f"'{path}' is missing and HCP_OFFLINE is set")
+    parent = os.path.dirname(path)
+    if parent and not os.path.isdir(parent):
+      os.makedirs(parent)
+    download_file(source['url'], path)
+
+  if source['sha256'] and file_sha256(path) != source['sha256']:
+    raise ValueError(f"Checksum mismatch for '{path}': expected {source['sha256']}")
+
+  return path
+
+#Function: Extract a tarball, dropping the leading path components
+
+def extract_tarball(fname, path, strip_components=1):
+  """
+  Extract a tarball, as `tar -xzf fname -C path --strip-components=N`.
+
+  Like GNU tar, members that would land outside path (absolute names, '..'
+  components, links pointing out of the archive) raise a ValueError.
+
+  Args:
+    fname (str) : Path of the .tgz archive
+    path (str) : Destination directory
+    strip_components (int) : Number of leading path components to drop
+  """
+  def unsafe(name):
+    return os.path.isabs(name) or os.path.normpath(name).split(os.sep)[0] == '..'
+
+  with tarfile.open(fname) as tar:
+    members = []
+    for member in tar.getmembers():
+      parts = member.name.split('/')[strip_components:]
+      if not parts or not parts[0]:
+        continue
+      member.name = '/'.join(parts)
+      if member.islnk():
+        # Hard links name another member, which lost the same components
+        member.linkname = '/'.join(member.linkname.split('/')[strip_components:])
+      target = os.path.join(os.path.dirname(member.name), member.linkname)
+      if (unsafe(member.name) or (member.issym() and unsafe(target)) or
+          (member.islnk() and unsafe(member.linkname))):
+        raise ValueError(f"Refusing to extract '{member.name}' from {fname}: "
+                         "it points outside the destination")
+      members.append(member)
+
+    # Python 3.11.4+ also applies its own checks (no devices, safe modes...)
+    if hasattr(tarfile, 'data_filter'):
+      tar.extractall(path, members=members, filter='data')
+    else:
+      tar.extractall(path, members=members)
+
+#Function: Make sure the HCP task dataset is available in HCP_DIR
+
+@profile_stage
+def ensure_dataset():
+  """
+  Make sure the HCP task dataset is available in HCP_DIR.
+
+  The archive is extracted once: a stamp file in HCP_DIR records the
+  checksum of the extracted archive, and later calls return right away.
+  A directory that already holds regions.npy is used as is when the
+  archive is not available.
+  """
+  stamp    = f"{HCP_DIR}/.hcp_task.stamp"
+  expected = DATA_SOURCES['hcp_task']['sha256']
+
+  if os.path.exists(stamp):
+    with open(stamp) as f:
+      extracted = f.read().strip()
+    if expected is None or extracted == expected:
+      return HCP_DIR
+
+  archive = DATA_SOURCES['hcp_task']['path']
+  if not os.path.exists(archive) and os.path.exists(f"{HCP_DIR}/regions.npy"):
+    return HCP_DIR
+
+  if not os.path.isdir(HCP_DIR):
+    os.makedirs(HCP_DIR)
+
+  archive = resolve_data('hcp_task')
+  extract_tarball(archive, HCP_DIR, strip_components=1)
+  with open(stamp, 'w') as f:
+    f.write(file_sha256(archive) + "\n")
+
+  return HCP_DIR
+
+#Function: Load the NMA atlas
+
+def load_atlas():
+  fname = resolve_data('atlas')
+  with np.load(fname) as dobj:
+    return dict(**dobj)
+
+#Function: Get the behavior information of the 339 subjects
+
+@profile_stage
+def get_subjects_behavior():
+  """
+  Get the behavior information of the 339 subjects, loading it on first use.
+
+  Returns:
+    SUBJECTS_BEHAVIOR (pandas.DataFrame): One row per subject, in the same
+      order as SUBJECTS, without columns with NaN values
+  """
+  global _SUBJECTS_BEHAVIOR
+  if _SUBJECTS_BEHAVIOR is not None:
+    return _SUBJECTS_BEHAVIOR
+
+  all_subjects = pd.read_csv(resolve_data('behavior'))
+
+  missing = set(SUBJECTS).difference(all_subjects['Subject'])
+  if missing:
+    raise ValueError(f"No behavior information for subjects {sorted(missing)}")
+
+  # The subjects of interest, in the same order as in the NMA-curated dataset
+  subjects_behavior = (all_subjects.drop_duplicates('Subject')
+                                   .set_index('Subject')
+                                   .reindex(SUBJECTS)
+                                   .reset_index())
+
+  # Remove columns with NaN values (before 582, after 489 columns)
+  subjects_behavior = subjects_behavior.loc[:, subjects_behavior.notna().all()]
 
-regions = np.load(f"{HCP_DIR}/regions.npy").T
-region_info = dict(
-    name=regions[0].tolist(),
-    network=regions[1],
-    hemi=['Right']*int(N_PARCELS/2) + ['Left']*int(N_PARCELS/2),
-)
+  # Compact dtypes: repeated strings become categories, integers become
+  # int32 when they fit (not smaller: int8/int16 overflow silently in sums)
+  strings     = subjects_behavior.select_dtypes(include=['object', 'string'])
+  categorical = strings.columns[strings.nunique() < len(subjects_behavior) // 2]
+  subjects_behavior = subjects_behavior.astype({column: 'category' for column in categorical})
 
-NETWORKS = set(region_info['network'])
-ROIs     = region_info['name']
+  integers = subjects_behavior.select_dtypes(include='integer')
+  int32    = np.iinfo(np.int32)
+  fits     = integers.columns[(integers.min() >= int32.min) & (integers.max() <= int32.max)]
+  subjects_behavior = subjects_behavior.astype({column: np.int32 for column in fits})
+
+  _SUBJECTS_BEHAVIOR = subjects_behavior
+  return _SUBJECTS_BEHAVIOR
+
+#Function: Get the region name, network and hemisphere of each parcel
+
+def get_region_info():
+  """
+  Get the region name, network and hemisphere of each parcel, loading
+  regions.npy on first use.
+
+  Returns:
+    region_info (dict): name (list), network (array) and hemi (list)
+  """
+  global _REGION_INFO
+  if _REGION_INFO is None:
+    ensure_dataset()
+    regions = np.load(f"{HCP_DIR}/regions.npy").T
+    _REGION_INFO = dict(
+        name=regions[0].tolist(),
+        network=regions[1],
+        hemi=['Right']*int(N_PARCELS/2) + ['Left']*int(N_PARCELS/2),
+    )
+  return _REGION_INFO
+
+# Module attributes built on first access (see the loaders above).
+# `features` lists all the columns available in SUBJECTS_BEHAVIOR:
+# cmd.Cmd().columnize(features, displaywidth=80)  # <-- Uncomment to see all features !!!
+_LAZY_GLOBALS = {
+    'SUBJECTS_BEHAVIOR' : lambda: get_subjects_behavior(),
+    'features'          : lambda: list(get_subjects_behavior().columns),
+    'region_info'       : lambda: get_region_info(),
+    'NETWORKS'          : lambda: set(get_region_info()['network']),
+    'ROIs'              : lambda: get_region_info()['name'],
+}
+
+def __getattr__(name):
+  if name in _LAZY_GLOBALS:
+    return _LAZY_GLOBALS[name]()
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Help functions
 
@@ -219,6 +610,7 @@ def load_timeseries(subject, experiment, runs=None, concat=True, remove_mean=Tru
   bold_data = [
       load_single_timeseries(subject, offset + run, remove_mean) for run in runs
   ]
+  count('subjects_processed')
 
   # Optionally concatenate in time
   if concat:
@@ -228,7 +620,7 @@ def load_timeseries(subject, experiment, runs=None, concat=True, remove_mean=Tru
 
 #Function: Load timeseries data for a single subject and single run
 
-def load_single_timeseries(subject, bold_run, remove_mean=True):
+def load_single_timeseries(subject, bold_run, remove_mean=True, subject_dir=None, dtype=None):
   """
   Load timeseries data for a single subject and single run.
   
@@ -236,16 +628,25 @@ def load_single_timeseries(subject, bold_run, remove_mean=True):
     subject (int): 0-based subject ID to load
     bold_run (int): 1-based run index, across all tasks
     remove_mean (bool): If True, subtract the parcel-wise mean
+    subject_dir (None or str): Directory of a subject outside of HCP_DIR
+      (see bold_file_path); subject is then ignored
+    dtype (None or dtype): Precision of the result, None uses DTYPE
 
   Returns
     ts (n_parcel x n_timepoint array): Array of BOLD data values
 
   """
 
-  bold_path = f"{HCP_DIR}/subjects/{subject}/timeseries"
-  bold_file = f"bold{bold_run}_Atlas_MSMAll_Glasser360Cortical.npy"
-  ts = np.load(f"{bold_path}/{bold_file}")
-  
+  # Serve a zero-copy view from the packed store when it exists
+  ts = load_packed_timeseries(subject, bold_run) if subject_dir is None else None
+  if ts is None:
+    ts = np.load(bold_file_path(subject, bold_run, subject_dir))
+    count('files_opened')
+  count('bytes_read', ts.nbytes)
+
+  # Cast once, at load time (no copy when the stored dtype is already DTYPE)
+  ts = ts.astype(DTYPE if dtype is None else dtype, copy=False)
+
   # # Compute z-score
   # for parcel in range(ts.shape[0]):
   #   parcel_mean = np.mean(ts[parcel])
@@ -255,13 +656,41 @@ def load_single_timeseries(subject, bold_run, remove_mean=True):
   #     ts[parcel][tp] = (ts[parcel][tp] - parcel_mean)/parcel_std
 
   if remove_mean:
-    ts -= ts.mean(axis=1, keepdims=True)
+    # Accumulate the mean in float64, whatever the precision of the data
+    mean = ts.mean(axis=1, keepdims=True, dtype=np.float64).astype(ts.dtype)
+    # Packed views are read-only, so subtract out of place for those
+    if ts.flags.writeable:
+      ts -= mean
+    else:
+      ts = ts - mean
 
   return ts
 
+#Function: Path of the timeseries file for a single subject and single run
+
+def bold_file_path(subject, bold_run, subject_dir=None):
+  """
+  Path of the timeseries file for a single subject and single run.
+
+  Args:
+    subject (int): 0-based subject ID
+    bold_run (int): 1-based run index, across all tasks
+    subject_dir (None or str): Directory of a subject with the same layout
+      outside of HCP_DIR (e.g. a new subject to score); subject is then ignored
+
+  Returns
+    path (str): Location of the .npy file inside HCP_DIR (or subject_dir)
+
+  """
+  if subject_dir is None:
+    subject_dir = f"{HCP_DIR}/subjects/{subject}"
+  bold_path = f"{subject_dir}/timeseries"
+  bold_file = f"bold{bold_run}_Atlas_MSMAll_Glasser360Cortical.npy"
+  return f"{bold_path}/{bold_file}"
+
 #Function: Load EV (explanatory variable) data for one task condition
 
-def load_evs(subject, experiment, condition):
+def load_evs(subject, experiment, condition, subject_dir=None):
   """
   Load EV (explanatory variable) data for one task condition.
 
@@ -269,42 +698,303 @@ def load_evs(subject, experiment, condition):
     subject (int): 0-based subject ID to load
     experiment (str) : Name of experiment
     condition (str) : Name of condition
+    subject_dir (None or str): Directory of a subject outside of HCP_DIR
+      (see bold_file_path); subject is then ignored
 
   Returns
     evs (list of dicts): A dictionary with the onset, duration, and amplitude
       of the condition for each run.
 
   """
+  if subject_dir is None:
+    subject_dir = f"{HCP_DIR}/subjects/{subject}"
+
   evs = []
   for id in get_image_ids(experiment):
     task_key = BOLD_NAMES[id - 1]
-    ev_file = f"{HCP_DIR}/subjects/{subject}/EVs/{task_key}/{condition}.txt"
+    ev_file = f"{subject_dir}/EVs/{task_key}/{condition}.txt"
     ev_array = np.loadtxt(ev_file, ndmin=2, unpack=True)
+    count('files_opened')
     ev = dict(zip(["onset", "duration", "amplitude"], ev_array))
     evs.append(ev)
   return evs
 
+# Packed BOLD store
+
+# One contiguous file per experiment, holding every subject/run back to back.
+PACKED_DIR = f"{HCP_DIR}/packed"
+
+# Opened stores (or None when an experiment has not been packed), by experiment
+_PACKED_STORES = {}
+
+#Function: Get the experiment name used by the packed store for a run
+
+def run_experiment(bold_run):
+  """
+  Get the experiment name used by the packed store for a run.
+
+  Args:
+    bold_run (int): 1-based run index, across all tasks
+
+  Returns:
+    experiment (str) : e.g. 'SOCIAL' for 'tfMRI_SOCIAL_RL', 'REST1' for 'rfMRI_REST1_LR'
+  """
+  return BOLD_NAMES[bold_run - 1].split('_')[1]
+
+#Function: Paths of the data and index files of a packed experiment
+
+def packed_store_paths(experiment):
+  experiment = experiment.upper()
+  return (f"{PACKED_DIR}/{experiment}_bold.npy",
+          f"{PACKED_DIR}/{experiment}_index.npz")
+
+#Function: Pack every subject/run of an experiment into a single on-disk array
+
+@profile_stage
+def pack_timeseries(experiment, overwrite=False, dtype=None):
+  """
+  Pack every subject/run of an experiment into a single on-disk array.
+
+  This is a one-time step: afterwards `load_single_timeseries` serves
+  memory-mapped views from the packed file instead of opening one .npy
+  per subject per run. The size and mtime of every source file are recorded,
+  and a run whose source file changed since is read from the file again.
+  An existing store is rebuilt when its sources or its dtype differ.
+
+  Args:
+    experiment (str) : Name of experiment to pack
+    overwrite (bool) : If True, rebuild the store even if it already exists
+    dtype (None or dtype) : Dtype of the store, None keeps the one of the
+      files (np.float32 halves the store, for DTYPE float32)
+
+  Returns:
+    data_file (str) : Path of the packed data file
+
+  Layout:
+    {experiment}_bold.npy    1D array with every (n_parcel x n_tp) run stored
+                             back to back (subject-major, then run)
+    {experiment}_index.npz   offsets (n_subjects x n_runs): start of each run
+                             shapes  (n_subjects x n_runs x 2): (n_parcel, n_tp)
+                             run_ids (n_runs): 1-based run indices
+                             sources (n_subjects x n_runs x 2): size and
+                               mtime (ns) of each source file
+  """
+  experiment = experiment.upper()
+  data_file, index_file = packed_store_paths(experiment)
+  run_ids = get_image_ids(experiment)
+
+  # First pass only reads the .npy headers, to size the store
+  shapes  = np.zeros((N_SUBJECTS, len(run_ids), 2), dtype=np.int64)
+  sources = np.zeros((N_SUBJECTS, len(run_ids), 2), dtype=np.int64)
+  stored  = None
+  for subject in range(N_SUBJECTS):
+    for r, bold_run in enumerate(run_ids):
+      path = bold_file_path(subject, bold_run)
+      ts = np.load(path, mmap_mode='r')
+      shapes[subject, r]  = ts.shape
+      sources[subject, r] = source_stat(path)
+      stored = ts.dtype if stored is None else np.promote_types(stored, ts.dtype)
+  dtype = np.dtype(stored if dtype is None else dtype)
+
+  # Keep an existing store only if it was packed from the same files, in the same dtype
+  if os.path.exists(index_file) and not overwrite:
+    store = open_packed_store(experiment)
+    if (store['data'].dtype == dtype and 'sources' in store and
+        np.array_equal(store['sources'], sources)):
+      return data_file
+    _PACKED_STORES.pop(experiment, None)
+
+  sizes   = shapes.prod(axis=-1).ravel()
+  offsets = np.zeros_like(sizes)
+  offsets[1:] = np.cumsum(sizes)[:-1]
+
+  if not os.path.isdir(PACKED_DIR):
+    os.makedirs(PACKED_DIR)
+
+  # Second pass copies the runs in the order they will be read back
+  tmp_file = f"{data_file}.tmp"
+  store = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype,
+                                    shape=(int(sizes.sum()),))
+  for i, (subject, bold_run) in enumerate(
+      (s, b) for s in range(N_SUBJECTS) for b in run_ids):
+    ts = np.load(bold_file_path(subject, bold_run))
+    store[offsets[i]:offsets[i] + sizes[i]] = ts.ravel()
+  store.flush()
+  del store
+  os.replace(tmp_file, data_file)
+
+  # The index is written last: its presence marks a complete store
+  with open(f"{index_file}.tmp", 'wb') as f:
+    np.savez(f, offsets=offsets.reshape(N_SUBJECTS, len(run_ids)),
+             shapes=shapes, run_ids=np.array(run_ids), sources=sources)
+  os.replace(f"{index_file}.tmp", index_file)
+
+  _PACKED_STORES.pop(experiment, None)
+  return data_file
+
+#Function: Size and modification time of a source file
+
+def source_stat(path):
+  stat = os.stat(path)
+  return stat.st_size, stat.st_mtime_ns
+
+#Function: Open the packed store of an experiment
+
+def open_packed_store(experiment):
+  """
+  Open the packed store of an experiment, memory-mapped read-only.
+
+  Args:
+    experiment (str) : Name of experiment
+
+  Returns:
+    store (dict or None): data (memmap), offsets, shapes and run_ids, or
+      None when the experiment has not been packed.
+  """
+  experiment = experiment.upper()
+  if experiment not in _PACKED_STORES:
+    data_file, index_file = packed_store_paths(experiment)
+    store = None
+    if os.path.exists(index_file):
+      with np.load(index_file) as index:
+        store = dict(index)
+      store['data'] = np.load(data_file, mmap_mode='r')
+    _PACKED_STORES[experiment] = store
+  return _PACKED_STORES[experiment]
+
+#Function: Load a single subject/run from the packed store
+
+def load_packed_timeseries(subject, bold_run):
+  """
+  Load a single subject/run from the packed store, without copying.
+
+  Args:
+    subject (int): 0-based subject ID to load
+    bold_run (int): 1-based run index, across all tasks
+
+  Returns
+    ts (n_parcel x n_timepoint array or None): Read-only view into the store,
+      or None if the run is not packed, its source file changed since it was
+      packed, or the store is less precise than DTYPE.
+  """
+  if not isinstance(subject, (int, np.integer)):
+    return None
+  store = open_packed_store(run_experiment(bold_run))
+  if store is None or bold_run not in store['run_ids'] or subject >= len(store['offsets']):
+    return None
+  if 'sources' not in store or not np.can_cast(DTYPE, store['data'].dtype):
+    return None
+
+  run = int(np.flatnonzero(store['run_ids'] == bold_run)[0])
+  try:
+    if tuple(store['sources'][subject, run]) != source_stat(bold_file_path(subject, bold_run)):
+      return None
+  except FileNotFoundError:
+    return None
+
+  start  = store['offsets'][subject, run]
+  shape  = tuple(store['shapes'][subject, run])
+  return store['data'][start:start + shape[0] * shape[1]].reshape(shape)
+
+#Function: Apply a function to every subject, optionally in parallel
+
+def map_subjects(func, *iterables, n_workers=None, processes=False):
+  """
+  Apply a function to every subject, optionally in parallel.
+
+  Threads suit the I/O-bound loading; processes suit the NumPy-bound
+  frame selection. Results always come back in the input order.
+
+  Args:
+    func (callable) : Function applied to each subject's arguments
+    iterables : One iterable per positional argument of func
+    n_workers (None or int) : Number of workers, None uses N_WORKERS.
+      None or 1 runs serially.
+    processes (bool) : If True, use a process pool instead of threads
+
+  Returns:
+    results (list): func's outputs, in subject order
+  """
+  if n_workers is None:
+    n_workers = N_WORKERS
+
+  if not n_workers or n_workers == 1:
+    return list(map(func, *iterables))
+
+  if processes:
+    iterables = [list(it) for it in iterables]
+    chunksize = max(1, len(iterables[0]) // (4 * n_workers))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+      return list(executor.map(func, *iterables, chunksize=chunksize))
+
+  with ThreadPoolExecutor(max_workers=n_workers) as executor:
+    return list(executor.map(func, *iterables))
+
 #Function: Get the indexes of all regions (parcels) of a network
 
 def network_indexes(net):
 
-  index_list = []
-  networks   = region_info['network']
+  indexes = get_network_index()['indexes']
 
-  if net not in networks:
+  if net not in indexes:
     raise ValueError(f"There's no network named '{net}'")
 
-  for i, network in enumerate(region_info['network']):
-    if net == network:
-      index_list.append(i)
-
-  return index_list
+  return indexes[net].tolist()
 
 #Function: Get regions (parcels) names of a network
 
 def get_regions_names(indexes):
-  names = region_info['name']
-  return [names[i] for i in indexes]
+  return get_network_index()['names'][indexes].tolist()
+
+#Function: Get the precomputed parcel -> network index
+
+def get_network_index():
+  """
+  Get the parcel -> network index, built once from region_info.
+
+  Returns:
+    network_index (dict):
+      networks (list of str): Network names, sorted
+      parcel_network (n_parcel array of int): Network of each parcel, as a
+        position in networks
+      indexes (dict): Parcel indexes of each network
+      matrix (n_networks x n_parcel array): One-hot rows scaled by the
+        network size, so matrix @ x averages x over each network
+      names (n_parcel array of str): Region name of each parcel
+  """
+  global _NETWORK_INDEX
+  if _NETWORK_INDEX is None:
+    region_info = get_region_info()
+    networks, parcel_network = np.unique(region_info['network'], return_inverse=True)
+
+    matrix = np.zeros((len(networks), len(parcel_network)))
+    matrix[parcel_network, np.arange(len(parcel_network))] = 1
+    matrix /= matrix.sum(axis=1, keepdims=True)
+
+    _NETWORK_INDEX = dict(
+        networks=networks.tolist(),
+        parcel_network=parcel_network,
+        indexes={net: np.flatnonzero(parcel_network == i) for i, net in enumerate(networks)},
+        matrix=matrix,
+        names=np.asarray(region_info['name']),
+    )
+  return _NETWORK_INDEX
+
+#Function: Reduce parcel-level features to the network level
+
+def network_features(features):
+  """
+  Reduce parcel-level features to the Ji et al. network level with a single
+  matrix multiply: each network gets the average of its parcels.
+
+  Args:
+    features (... x n_parcel array): Parcel-level features, e.g. get_features
+
+  Returns:
+    network_features (... x n_networks array): Columns follow
+      get_network_index()['networks']
+  """
+  return features @ get_network_index()['matrix'].T.astype(features.dtype, copy=False)
 
 #Task-based analysis
 
@@ -330,13 +1020,117 @@ def condition_frames(run_evs):
     # Use trial duration to determine how many frames to include for trial
     duration = np.ceil(ev["duration"] / TR).astype(int)
 
-    # Take the range of frames that correspond to this specific trial
-    frames = [s + np.arange(0, d) for s, d in zip(start, duration)]
+    # Take the range of frames that correspond to each trial in one go:
+    # frame k of trial i is start[i] + k
+    ends   = np.cumsum(duration)
+    steps  = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - duration, duration)
+    frames = np.repeat(start, duration) + steps
 
-    frames_list.append(np.concatenate(frames))
+    frames_list.append(frames)
 
   return frames_list
 
+# Frame index
+
+# Frame indices per run, by (HCP_DIR, subject, experiment, condition), with
+# the modification times of the EV files they came from. EV timings are
+# compiled once and reused by every later selection, until an EV file changes.
+_FRAME_INDEX = {}
+
+#Function: Get the (cached) frame indices of a condition for a single subject
+
+def get_condition_frames(subject, experiment, condition):
+  """
+  Get the frame indices of a condition for a single subject, compiling
+  the EV files only the first time they are requested (or when they changed
+  since).
+
+  Args:
+    subject (int): 0-based subject ID
+    experiment (str) : Name of experiment
+    condition (str) : Name of condition
+
+  Returns:
+    frames_list (list of 1D arrays): Flat arrays of frame indices, per run
+  """
+  key = (HCP_DIR, subject, experiment.upper(), condition)
+  ev_files = [f"{HCP_DIR}/subjects/{subject}/EVs/{BOLD_NAMES[id - 1]}/{condition}.txt"
+              for id in get_image_ids(experiment)]
+  mtimes = [os.stat(ev_file).st_mtime_ns for ev_file in ev_files]
+
+  entry = _FRAME_INDEX.get(key)
+  if entry is None or entry[0] != mtimes:
+    entry = (mtimes, condition_frames(load_evs(subject, experiment, condition)))
+    _FRAME_INDEX[key] = entry
+  return entry[1]
+
+#Function: Forget the compiled frame indices
+
+def clear_frame_index():
+  _FRAME_INDEX.clear()
+
+#Function: Precompute the frame index for a whole experiment
+
+@profile_stage
+def build_frame_index(experiment, conditions=None, subjects=None, n_workers=None):
+  """
+  Precompute the frame index of every (subject, condition) of an experiment.
+
+  Args:
+    experiment (str) : Name of experiment
+    conditions (None or list of str) : Conditions to index, None for CONDITIONS
+    subjects (None or iterable of int) : 0-based subject IDs, None for all
+    n_workers (None or int) : Threads used to read the EV files
+
+  Returns:
+    frame_index (dict): frames per run, by (subject, experiment, condition)
+  """
+  if conditions is None:
+    conditions = CONDITIONS
+  if subjects is None:
+    subjects = range(N_SUBJECTS)
+
+  load = functools.partial(load_subject_frames, experiment=experiment,
+                           conditions=conditions)
+  map_subjects(load, subjects, n_workers=n_workers)
+
+  return {key[1:]: frames for key, (_, frames) in _FRAME_INDEX.items() if key[0] == HCP_DIR}
+
+#Function: Load the frame indices of every condition for a single subject
+
+def load_subject_frames(subject, experiment, conditions=None):
+  if conditions is None:
+    conditions = CONDITIONS
+  return [get_condition_frames(subject, experiment, cond) for cond in conditions]
+
+#Function: Gather the given frames from each image
+
+def gather_frames(timeseries_data, frames):
+  """
+  Gather the given frames from each image.
+
+  Args:
+    timeseries_data (array or list of arrays): n_parcel x n_tp arrays
+    frames (1D array or list of 1D arrays): Frame indices, per run
+
+  Returns:
+    selected_data (list of arrays): n_parcel x n_frames arrays, per run
+  """
+  if not isinstance(timeseries_data, list):
+    timeseries_data = [timeseries_data]
+  if not isinstance(frames, list):
+    frames = [frames]
+  if len(timeseries_data) != len(frames):
+    raise ValueError("Length of `timeseries_data` and `frames` must match.")
+
+  selected_data = []
+  for run_data, run_frames in zip(timeseries_data, frames):
+    run_frames = run_frames[run_frames < run_data.shape[1]]
+    selected_data.append(np.take(run_data, run_frames, axis=1))
+    count('frames_selected', len(run_frames))
+
+  return selected_data
+
 #Function: Select the frames from each image. 
 #Returns a list with two numpy arrays, one for each condition. Each entry of any numpy array corresponds to a matrix (360, 274) of 360 parcels, 274 time points.
 
@@ -372,7 +1166,8 @@ def select_frames(timeseries_data, ev):
   Beware:
     Subject 3 and 98 show the following   run_0:  96 tp (both conditions)
                                           run_1:  64 tp (both conditions)
-  Exclude them before
+  remove_excess computes the target length per subject, so they need no
+  special handling.
   """
 
   # Ensure that we have lists of the same length
@@ -383,104 +1178,187 @@ def select_frames(timeseries_data, ev):
   if len(timeseries_data) != len(ev):
     raise ValueError("Length of `timeseries_data` and `ev` must match.")
 
-  # Identify the indices of relevant frames
-  frames = condition_frames(ev)
-
-  # Select the frames from each image
-  selected_data = []
-  for run_data, run_frames in zip(timeseries_data, frames):
-    run_frames = run_frames[run_frames < run_data.shape[1]]
-    selected_data.append(run_data[:, run_frames])
-
-  return selected_data
+  # Identify the indices of relevant frames and select them from each image
+  return gather_frames(timeseries_data, condition_frames(ev))
 
 #Function: Load a concatenated timeseries
 #For an experiment (using all runs' data) for each subject.
 
 
-def get_timeseries(experiment, concat=False):
-  
-  timeseries = []
+@profile_stage
+def get_timeseries(experiment, concat=False, n_workers=None):
+  """
+  Load the timeseries of every subject for an experiment.
 
-  for subject in range(N_SUBJECTS):
-    ts_concat = load_timeseries(subject, experiment, concat=concat)
-    timeseries.append(ts_concat)  
+  Args:
+    experiment (str) : Name of experiment to load
+    concat (bool) : If True, concatenate multiple runs in time
+    n_workers (None or int) : Threads used to read the files,
+      None uses N_WORKERS
 
-  return timeseries
+  Returns:
+    timeseries (list): One entry per subject, in subject order
+  """
+  load = functools.partial(load_timeseries, experiment=experiment, concat=concat)
+  return map_subjects(load, range(N_SUBJECTS), n_workers=n_workers)
 
-#Function: Gets BOLD signal in each region/condition/subject
+#Function: Get the difference between two conditions' averages in one pass
 
-def get_BOLD(time_series, experiment):
-  
-  all_BOLDs = []
-  for subject in range(N_SUBJECTS):
-    evs  = [load_evs(subject, experiment, cond) for cond in CONDITIONS]
-    data = [select_frames(time_series[subject], ev) for ev in evs]
-    all_BOLDs.append(data)
+def condition_difference(run_data, frames_0, frames_1):
+  """
+  Get the difference between two conditions' average BOLD signal in one
+  pass, without materialising the selected frames.
 
-  return all_BOLDs
+  Equivalent to select_frames -> remove_excess -> get_average_by_region ->
+  get_difference for a single subject and run: each condition keeps its
+  first n frames, n being the size of the smaller one.
 
-#Function:Reduces the excess of BOLD signals timepoints for conditions with different size.
+  Args:
+    run_data (n_parcel x n_tp array): BOLD data of a single run
+    frames_0 (1D array): Frame indices of the first condition
+    frames_1 (1D array): Frame indices of the second condition
 
-def remove_excess(data, run):
+  Returns:
+    difference (1D array): n_parcel averages of condition 0 minus condition 1
+  """
+  n_tps    = run_data.shape[1]
+  frames_0 = frames_0[frames_0 < n_tps]
+  frames_1 = frames_1[frames_1 < n_tps]
 
-  new_data = []
+  # Truncate both conditions to the same number of timepoints
+  n_frames = min(len(frames_0), len(frames_1))
+  frames_0 = frames_0[:n_frames]
+  frames_1 = frames_1[:n_frames]
+  count('frames_selected', 2 * n_frames)
 
-  # Get the number of timepoints per condition
-  tps_c_0 = data[0][run][0].shape[1]
-  tps_c_1 = data[0][run][1].shape[1]
+  # Weight frames +1/n for condition 0 and -1/n for condition 1, so a single
+  # matrix-vector product yields the difference of the two means
+  weights = (np.bincount(frames_0, minlength=n_tps) -
+             np.bincount(frames_1, minlength=n_tps)) / n_frames
 
-  # Stop when both conditions have same number of timepoints
-  if tps_c_0 == tps_c_1:
-      return data
+  # Weights in the data's precision, so float32 data is not promoted
+  return run_data @ weights.astype(run_data.dtype, copy=False)
 
-  # Get the number of timepoints to reduce and in which
-  # 'condition' should be reduced.
-  if tps_c_0 < tps_c_1:
-    tps_to_reduce = tps_c_1 - tps_c_0
-    remove_condition = True
-  else: 
-    tps_to_reduce = tps_c_0 - tps_c_1
-    remove_condition = False
+#Function: Get the average BOLD signal of one condition in one pass
 
-  # Start reduction.
-  for subject in range(N_SUBJECTS):
+def condition_mean(run_data, frames):
+  """
+  Get the average BOLD signal of one condition in one pass, without
+  materialising the selected frames.
 
-    parcel_tps_cond_0 = data[subject][run][0]
-    parcel_tps_cond_1 = data[subject][run][1]
+  Args:
+    run_data (n_parcel x n_tp array): BOLD data of a single run
+    frames (1D array): Frame indices of the condition
 
-    for _ in range(tps_to_reduce):
+  Returns:
+    average (1D array): n_parcel averages
+  """
+  n_tps  = run_data.shape[1]
+  frames = frames[frames < n_tps]
+  count('frames_selected', len(frames))
+  weights = np.bincount(frames, minlength=n_tps) / len(frames)
+  return run_data @ weights.astype(run_data.dtype, copy=False)
 
-      if remove_condition:
-        parcel_tps_cond_1 = np.delete(parcel_tps_cond_1, -1, 1)
-      else:
-        parcel_tps_cond_0 = np.delete(parcel_tps_cond_0, -1, 1)
+#Function: Select the frames of every condition for a single subject
 
-    # New data has only the two conditions for the given run
-    new_data.append([parcel_tps_cond_0, parcel_tps_cond_1])
+def select_subject_frames(subject_ts, subject_frames):
+  by_condition = [gather_frames(subject_ts, frames) for frames in subject_frames]
+  # Reorder as [run][condition]
+  return [list(run) for run in zip(*by_condition)]
 
-  return new_data
+#Function: Gets BOLD signal in each region/condition/subject
 
-#Function:Get vertical average (regions across subjects)
+@profile_stage
+def get_BOLD(time_series, experiment, n_workers=None, frame_workers=None):
+  """
+  Gets BOLD signal in each region/condition/subject.
 
-def get_average_all_subjects(data):
+  Args:
+    time_series (list): Output of get_timeseries
+    experiment (str) : Name of experiment
+    n_workers (None or int) : Threads used to read the EV files,
+      None uses N_WORKERS
+    frame_workers (None or int) : If set, processes used for frame selection
 
-  avg_subjects_cond_0 = []
-  avg_subjects_cond_1 = []
+  Returns:
+    all_BOLDs (list): all_BOLDs[subject][run][condition], in subject order
+  """
+  load       = functools.partial(load_subject_frames, experiment=experiment)
+  all_frames = map_subjects(load, range(N_SUBJECTS), n_workers=n_workers)
 
-  for subject in range(len(data)):
-    avg_subjects_cond_0.append(data[subject][0])
-    avg_subjects_cond_1.append(data[subject][1])
+  if frame_workers:
+    return map_subjects(select_subject_frames, time_series[:N_SUBJECTS], all_frames,
+                        n_workers=frame_workers, processes=True)
 
-  np_avg_subjects_c0 = np.mean(np.array(avg_subjects_cond_0), axis=0)
-  np_avg_subjects_c1 = np.mean(np.array(avg_subjects_cond_1), axis=0)
+  return [select_subject_frames(time_series[subject], all_frames[subject])
+          for subject in range(N_SUBJECTS)]
 
-  return [np_avg_subjects_c0, np_avg_subjects_c1]
+#Function:Reduces the excess of BOLD signals timepoints for conditions with different size.
 
-#Function:Get horizontal average (timepoints for each region/subject)
+@profile_stage
+def remove_excess(data, run):
+  """
+  Reduces the excess of BOLD signal timepoints so that both conditions of a
+  run have the same number of timepoints.
+
+  The target length is computed for every subject (and run), and the longer
+  condition is trimmed with a slice, so no data is copied.
+
+  Args:
+    data (list): Output of get_BOLD, data[subject][run][condition]
+    run (None or int): 0-based run to keep, None keeps every run
+
+  Returns:
+    new_data (list): new_data[subject][condition] for the given run, or
+      new_data[subject][run][condition] when run is None
+  """
+  runs = range(len(data[0])) if run is None else [run]
+
+  # Timepoints of every (subject, run, condition), stacked in one array
+  tps     = np.array([[[cond.shape[1] for cond in subject[r]] for r in runs]
+                      for subject in data])
+  targets = tps.min(axis=-1)
+
+  new_data = [
+      [[cond[:, :n_tps] for cond in subject[r]] for r, n_tps in zip(runs, subject_targets)]
+      for subject, subject_targets in zip(data, targets)
+  ]
+
+  # Only the two conditions of the given run
+  if run is not None:
+    new_data = [subject[0] for subject in new_data]
+
+  return new_data
+
+#Function:Get vertical average (regions across subjects)
+
+def get_average_all_subjects(data):
+
+  # Dense (subjects x ... x conditions x parcels) arrays reduce in one call
+  if isinstance(data, np.ndarray):
+    return data.mean(axis=0)
+
+  avg_subjects_cond_0 = []
+  avg_subjects_cond_1 = []
+
+  for subject in range(len(data)):
+    avg_subjects_cond_0.append(data[subject][0])
+    avg_subjects_cond_1.append(data[subject][1])
+
+  np_avg_subjects_c0 = np.mean(np.array(avg_subjects_cond_0), axis=0)
+  np_avg_subjects_c1 = np.mean(np.array(avg_subjects_cond_1), axis=0)
+
+  return [np_avg_subjects_c0, np_avg_subjects_c1]
+
+#Function:Get horizontal average (timepoints for each region/subject)
+
+@profile_stage
+def get_average_by_region(data):
+
+  # A BOLDTensor already holds its (subjects x runs x conditions x parcels) means
+  if isinstance(data, BOLDTensor):
+    return data.means
 
-def get_average_by_region(data):
-  
   averages = []
 
   for subject in range(len(data)):
@@ -492,14 +1370,534 @@ def get_average_by_region(data):
 
 #Function: Get difference between conditions
 
+@profile_stage
 def get_difference(averages):
-  
+
+  if isinstance(averages, np.ndarray):
+    return averages[..., 0, :] - averages[..., 1, :]
+
   difference = []
   for subject in range(len(averages)):
     difference.append(averages[subject][0] - averages[subject][1])
 
   return difference
 
+# Dense BOLD tensor
+
+class BOLDTensor:
+  """
+  Dense, array-backed container for the output of get_BOLD.
+
+  Attributes:
+    means (n_subjects x n_runs x n_conditions x n_parcel array): Average BOLD
+      signal of each region/condition/run/subject
+    timepoints (None or n_parcel x total_tp array): Selected frames of every
+      (subject, run, condition), stored back to back
+    offsets (None or n_subjects x n_runs x n_conditions array): Start of each
+      (subject, run, condition) in timepoints
+    lengths (None or n_subjects x n_runs x n_conditions array): Number of
+      frames of each (subject, run, condition)
+
+  Structure:
+    tensor.means[subject][run][condition][roi]
+    tensor.frames(subject, run, condition)    (360, c) view into timepoints
+
+  Indexing a tensor by subjects returns a new tensor that shares the
+  ragged timepoint storage. Its means are a view for a slice of subjects,
+  and a (small) copy for a list of subjects.
+  """
+
+  __slots__ = ('means', 'timepoints', 'offsets', 'lengths')
+
+  def __init__(self, means, timepoints=None, offsets=None, lengths=None):
+    self.means      = means
+    self.timepoints = timepoints
+    self.offsets    = offsets
+    self.lengths    = lengths
+
+  @classmethod
+  def from_BOLD(cls, data, keep_timepoints=False):
+    """
+    Build a tensor from nested data[subject][run][condition] arrays, as
+    returned by get_BOLD or remove_excess(data, None).
+
+    Args:
+      data (list): data[subject][run][condition] n_parcel x c arrays
+      keep_timepoints (bool) : If True, also keep the selected frames
+
+    Returns:
+      tensor (BOLDTensor)
+    """
+    n_subjects, n_runs, n_conditions = len(data), len(data[0]), len(data[0][0])
+    n_parcels = data[0][0][0].shape[0]
+    dtype     = data[0][0][0].dtype
+    conds     = [cond for subject in data for run in subject for cond in run]
+
+    lengths = np.array([cond.shape[1] for cond in conds], dtype=np.int64)
+
+    if not keep_timepoints:
+      means = np.empty((len(conds), n_parcels), dtype=dtype)
+      for i, cond in enumerate(conds):
+        means[i] = cond.mean(axis=1)
+      shape = (n_subjects, n_runs, n_conditions)
+      return cls(means.reshape(shape + (n_parcels,)))
+
+    offsets = np.zeros(lengths.size, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)[:-1]
+
+    # One zero column after the frames keeps every offset a valid reduceat
+    # index (trailing empty segments start at the very end) without cutting
+    # the segment before them; timepoints is a view without it
+    padded = np.concatenate(conds + [np.zeros((n_parcels, 1), dtype=dtype)], axis=1)
+    timepoints = padded[:, :-1]
+
+    # Every mean from one segmented sum over the stored frames (float64
+    # accumulator); empty segments get NaN, as the mean of no frames
+    sums = np.add.reduceat(padded, offsets, axis=1, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+      means = np.where(lengths > 0, sums / lengths, np.nan).T.astype(dtype)
+
+    shape = (n_subjects, n_runs, n_conditions)
+    return cls(means.reshape(shape + (n_parcels,)), timepoints,
+               offsets.reshape(shape), lengths.reshape(shape))
+
+  @property
+  def shape(self):
+    return self.means.shape
+
+  def __len__(self):
+    return len(self.means)
+
+  def __getitem__(self, subjects):
+    if self.timepoints is None:
+      return BOLDTensor(self.means[subjects])
+    return BOLDTensor(self.means[subjects], self.timepoints,
+                      self.offsets[subjects], self.lengths[subjects])
+
+  def frames(self, subject, run, condition):
+    """Selected frames of one (subject, run, condition), as a view."""
+    if self.timepoints is None:
+      raise ValueError("This tensor was built without keep_timepoints.")
+    start = self.offsets[subject, run, condition]
+    return self.timepoints[:, start:start + self.lengths[subject, run, condition]]
+
+  def run(self, run):
+    """Averages of a single run: (n_subjects x n_conditions x n_parcel) view."""
+    return self.means[:, run]
+
+  def average_subjects(self, run):
+    """Average of each region/condition across subjects, for a single run."""
+    return self.means[:, run].mean(axis=0)
+
+  def difference(self, run, conditions=(0, 1)):
+    """Difference between two conditions' averages: (n_subjects x n_parcel)."""
+    c_0, c_1 = conditions
+    return self.means[:, run, c_0] - self.means[:, run, c_1]
+
+  def split(self, female_indexes, male_indexes):
+    """
+    Split subjects by gender, as divide_by_gender does. Both tensors share
+    the timepoint storage; their means are copies.
+    """
+    return self[np.asarray(female_indexes)], self[np.asarray(male_indexes)]
+
+# Streaming feature extraction
+
+#Function: Iterate over subjects' timeseries, one subject at a time
+
+def iter_timeseries(experiment, subjects=None, concat=False, remove_mean=True):
+  """
+  Lazy counterpart of get_timeseries: yields one subject at a time.
+
+  Args:
+    experiment (str) : Name of experiment to load
+    subjects (None or iterable of int) : 0-based subject IDs, None for all
+    concat (bool) : If True, concatenate multiple runs in time
+    remove_mean (bool) : If True, subtract the parcel-wise mean
+
+  Yields:
+    (subject, ts) : 0-based subject ID and its timeseries
+  """
+  if subjects is None:
+    subjects = range(N_SUBJECTS)
+  for subject in subjects:
+    yield subject, load_timeseries(subject, experiment, concat=concat,
+                                   remove_mean=remove_mean)
+
+#Function: Iterate over subjects' condition differences, one subject at a time
+
+def iter_features(experiment, run=0, subjects=None, remove_mean=True, conditions=None):
+  """
+  Stream subjects through load -> condition_difference, keeping nothing but
+  the current subject in memory.
+
+  Args:
+    experiment (str) : Name of experiment
+    run (int) : 0-based run of the task
+    subjects (None or iterable of int) : 0-based subject IDs, None for all
+    remove_mean (bool) : If True, subtract the parcel-wise mean
+    conditions (None or list of str) : The two conditions, None for CONDITIONS
+
+  Yields:
+    (subject, difference) : 0-based subject ID and the (n_parcel,) difference
+      between the first and the second condition
+  """
+  if subjects is None:
+    subjects = range(N_SUBJECTS)
+  bold_run = get_image_ids(experiment)[run]
+
+  for subject in subjects:
+    ts     = load_single_timeseries(subject, bold_run, remove_mean)
+    frames = load_subject_frames(subject, experiment, conditions)
+    count('subjects_processed')
+    yield subject, condition_difference(ts, frames[0][run], frames[1][run])
+
+#Function: Collect the streamed condition differences into a feature matrix
+
+@profile_stage
+def get_features(experiment, run=0, subjects=None, remove_mean=True, conditions=None):
+  """
+  Collect the streamed condition differences into a feature matrix.
+
+  Args:
+    experiment (str) : Name of experiment
+    run (int) : 0-based run of the task
+    subjects (None or list of int) : 0-based subject IDs, None for all
+    remove_mean (bool) : If True, subtract the parcel-wise mean
+    conditions (None or list of str) : The two conditions, None for CONDITIONS
+
+  Returns:
+    features (n_subjects x n_parcel array): One row per subject, in order
+  """
+  if subjects is None:
+    subjects = range(N_SUBJECTS)
+  features = np.empty((len(subjects), N_PARCELS), dtype=DTYPE)
+  for i, (_, difference) in enumerate(
+      iter_features(experiment, run, subjects, remove_mean, conditions)):
+    features[i] = difference
+  return features
+
+# Feature cache
+
+#Function: Get the feature cache key of an experiment/run/options
+
+def feature_cache_key(experiment, run=0, subjects=None, remove_mean=True, conditions=None):
+  """
+  Get the feature cache key: a hash of the extraction parameters and the
+  modification times of every source file they read.
+
+  Args:
+    experiment (str) : Name of experiment
+    run (int) : 0-based run of the task
+    subjects (None or list of int) : 0-based subject IDs, None for all
+    remove_mean (bool) : If True, subtract the parcel-wise mean
+    conditions (None or list of str) : The two conditions, None for CONDITIONS
+
+  Returns:
+    key (str): Hexadecimal digest
+  """
+  if subjects is None:
+    subjects = range(N_SUBJECTS)
+  if conditions is None:
+    conditions = CONDITIONS
+
+  bold_run = get_image_ids(experiment)[run]
+  task_key = BOLD_NAMES[bold_run - 1]
+
+  sources = list(packed_store_paths(run_experiment(bold_run)))
+  for subject in subjects:
+    sources.append(bold_file_path(subject, bold_run))
+    sources += [f"{HCP_DIR}/subjects/{subject}/EVs/{task_key}/{cond}.txt" for cond in conditions]
+  mtimes = [os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in sources]
+
+  params = dict(experiment=experiment.upper(), run=run, subjects=[int(i) for i in subjects],
+                remove_mean=remove_mean, conditions=list(conditions), mtimes=mtimes,
+                dtype=DTYPE.str)
+  return hashlib.sha1(json.dumps(params).encode()).hexdigest()
+
+#Function: Get a feature matrix, from the cache when available
+
+@profile_stage
+def cached_features(experiment, run=0, subjects=None, remove_mean=True, conditions=None):
+  """
+  Get the feature matrix of get_features, from the on-disk cache when it
+  has already been computed with the same parameters and source files.
+
+  Args:
+    experiment (str) : Name of experiment
+    run (int) : 0-based run of the task
+    subjects (None or list of int) : 0-based subject IDs, None for all
+    remove_mean (bool) : If True, subtract the parcel-wise mean
+    conditions (None or list of str) : The two conditions, None for CONDITIONS
+
+  Returns:
+    features (n_subjects x n_parcel array): One row per subject, in order
+  """
+  key  = feature_cache_key(experiment, run, subjects, remove_mean, conditions)
+  path = f"{FEATURE_CACHE_DIR}/{key}.npy"
+
+  if os.path.exists(path):
+    # Refresh the modification time, which orders the LRU eviction
+    os.utime(path)
+    return np.load(path)
+
+  features = get_features(experiment, run, subjects, remove_mean, conditions)
+
+  if not os.path.isdir(FEATURE_CACHE_DIR):
+    os.makedirs(FEATURE_CACHE_DIR)
+  with open(f"{path}.tmp", 'wb') as f:
+    np.save(f, features)
+  os.replace(f"{path}.tmp", path)
+  evict_feature_cache()
+
+  return features
+
+#Function: Evict the least recently used feature matrices
+
+def evict_feature_cache(max_bytes=None):
+  """
+  Evict the least recently used feature matrices until the cache fits.
+
+  Args:
+    max_bytes (None or int) : Size limit, None uses FEATURE_CACHE_SIZE
+
+  Returns:
+    evicted (list of str): Paths of the removed files
+  """
+  if max_bytes is None:
+    max_bytes = FEATURE_CACHE_SIZE
+  if not os.path.isdir(FEATURE_CACHE_DIR):
+    return []
+
+  entries = [entry for entry in os.scandir(FEATURE_CACHE_DIR) if entry.name.endswith('.npy')]
+  entries.sort(key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+
+  evicted, total = [], 0
+  for entry in entries:
+    total += entry.stat().st_size
+    if total > max_bytes:
+      os.remove(entry.path)
+      evicted.append(entry.path)
+
+  return evicted
+
+# Multi-task feature extraction
+
+# One entry of a feature specification:
+#   experiment (str) : Name of experiment, e.g. 'SOCIAL' or 'REST1'
+#   conditions (None, str or pair of str) : None for the whole-run average,
+#     a condition for its average, or a pair for their difference
+#   run (int) : 0-based run of the task
+FeatureSpec = namedtuple('FeatureSpec', ['experiment', 'conditions', 'run'])
+
+# One contrast per task, run 0. REST runs have no EVs, so they use the whole-run average.
+TASK_CONTRASTS = [
+  FeatureSpec('MOTOR',      ('rh', 'lh'),             0),
+  FeatureSpec('WM',         ('2bk_body', '0bk_body'), 0),
+  FeatureSpec('EMOTION',    ('fear', 'neut'),         0),
+  FeatureSpec('GAMBLING',   ('win', 'loss'),          0),
+  FeatureSpec('LANGUAGE',   ('story', 'math'),        0),
+  FeatureSpec('RELATIONAL', ('relation', 'match'),    0),
+  FeatureSpec('SOCIAL',     ('mental', 'rnd'),        0),
+]
+
+#Function: Get the name of a feature specification entry
+
+def spec_label(spec):
+  if spec.conditions is None:
+    conditions = 'all'
+  elif isinstance(spec.conditions, str):
+    conditions = spec.conditions
+  else:
+    conditions = '-'.join(spec.conditions)
+  bold_run = get_image_ids(spec.experiment)[spec.run]
+  return f"{spec.experiment.upper()}_{BOLD_NAMES[bold_run - 1].split('_')[-1]}_{conditions}"
+
+#Function: Compute every requested feature of a single subject
+
+def subject_spec_features(subject, specs, remove_mean=True):
+  """
+  Compute every requested feature of a single subject, loading each run's
+  timeseries once no matter how many entries use it.
+
+  Args:
+    subject (int): 0-based subject ID
+    specs (list of FeatureSpec) : Features to compute
+    remove_mean (bool) : If True, subtract the parcel-wise mean
+
+  Returns:
+    features (1D array): n_parcel values per entry of specs, concatenated
+  """
+  count('subjects_processed')
+  timeseries = {}
+  features   = []
+
+  for spec in specs:
+    bold_run = get_image_ids(spec.experiment)[spec.run]
+    if bold_run not in timeseries:
+      timeseries[bold_run] = load_single_timeseries(subject, bold_run, remove_mean)
+    ts = timeseries[bold_run]
+
+    if spec.conditions is None:
+      features.append(ts.mean(axis=1))
+    elif isinstance(spec.conditions, str):
+      frames = get_condition_frames(subject, spec.experiment, spec.conditions)[spec.run]
+      features.append(condition_mean(ts, frames))
+    else:
+      frames = [get_condition_frames(subject, spec.experiment, cond)[spec.run]
+                for cond in spec.conditions]
+      features.append(condition_difference(ts, *frames))
+
+  return np.concatenate(features)
+
+#Function: Extract a wide feature matrix for several tasks in a single pass
+
+@profile_stage
+def extract_features(specs, subjects=None, remove_mean=True, n_workers=None, level='parcel'):
+  """
+  Extract a wide feature matrix for several tasks in a single pass over
+  the subjects.
+
+  Args:
+    specs (list of FeatureSpec or tuples) : Features to compute, e.g. TASK_CONTRASTS
+    subjects (None or list of int) : 0-based subject IDs, None for all
+    remove_mean (bool) : If True, subtract the parcel-wise mean
+    n_workers (None or int) : Threads used to process subjects,
+      None uses N_WORKERS
+    level (str) : 'parcel' for one value per parcel, 'network' for one value
+      per network (see network_features)
+
+  Returns:
+    features (n_subjects x (n_specs * n_values) array): One row per subject
+    columns (list of str): Name of each column, '{experiment}_{run}_{conditions}/{parcel}'
+      or '{experiment}_{run}_{conditions}/{network}'
+
+  Example:
+  >>> features, columns = extract_features(TASK_CONTRASTS)
+  >>> features, columns = extract_features([('SOCIAL', ('mental', 'rnd'), 0),
+  ...                                       ('REST1', None, 0)])
+  """
+  specs = [FeatureSpec(*spec) for spec in specs]
+  for spec in specs:
+    if spec.run >= len(get_image_ids(spec.experiment)):
+      raise ValueError(f"Run {spec.run} does not exist for '{spec.experiment}'")
+  if level not in ('parcel', 'network'):
+    raise ValueError(f"Unknown level '{level}', it should be 'parcel' or 'network'")
+
+  if subjects is None:
+    subjects = range(N_SUBJECTS)
+
+  features = np.empty((len(subjects), len(specs) * N_PARCELS), dtype=DTYPE)
+  compute  = functools.partial(subject_spec_features, specs=specs, remove_mean=remove_mean)
+  for i, row in enumerate(map_subjects(compute, subjects, n_workers=n_workers)):
+    features[i] = row
+
+  if level == 'network':
+    features = network_features(features.reshape(len(subjects), len(specs), N_PARCELS))
+    features = features.reshape(len(subjects), -1)
+    columns  = [f"{spec_label(spec)}/{net}" for spec in specs
+                for net in get_network_index()['networks']]
+    return features, columns
+
+  columns = [f"{spec_label(spec)}/{parcel}" for spec in specs for parcel in range(N_PARCELS)]
+  return features, columns
+
+# Functional connectivity features
+
+# Connectivity results are streamed to this directory, one file per condition/run
+CONNECTIVITY_DIR = f"{HCP_DIR}/connectivity"
+
+#Function: Correlation between every pair of parcels over the selected frames
+
+def connectivity_features(run_data, frames=None, block_size=64, dtype=np.float32):
+  """
+  Correlation between every pair of parcels over the selected frames.
+
+  The correlation matrix is computed in blocks of rows, in reduced precision,
+  and only its upper triangle is kept (64,620 values for 360 parcels).
+
+  Args:
+    run_data (n_parcel x n_tp array): BOLD data of a single run
+    frames (None or 1D array): Frame indices of a condition, None for all
+    block_size (int) : Number of parcels per block
+    dtype (numpy dtype) : Precision of the computation
+
+  Returns:
+    connectivity (1D array): Upper triangle (without the diagonal), in the
+      order of np.triu_indices(n_parcel, 1)
+  """
+  if frames is not None:
+    run_data = gather_frames(run_data, frames)[0]
+  data = np.asarray(run_data, dtype=dtype)
+
+  # Rows are centred and scaled to unit norm, so correlations are dot products
+  z = data - data.mean(axis=1, keepdims=True, dtype=np.float64).astype(dtype)
+  norms = np.linalg.norm(z, axis=1, keepdims=True)
+  norms[norms == 0] = 1
+  z /= norms
+
+  n_parcels    = len(z)
+  connectivity = np.empty(n_parcels * (n_parcels - 1) // 2, dtype=dtype)
+  position     = 0
+  for start in range(0, n_parcels, block_size):
+    stop  = min(start + block_size, n_parcels)
+    block = z[start:stop] @ z[start:].T
+
+    # Keep the columns to the right of the diagonal, row by row
+    upper = np.arange(n_parcels - start)[None, :] > np.arange(stop - start)[:, None]
+    values = block[upper]
+    connectivity[position:position + len(values)] = values
+    position += len(values)
+
+  return connectivity
+
+#Function: Stream the connectivity of every subject to disk
+
+@profile_stage
+def stream_connectivity(experiment, condition=None, run=0, subjects=None,
+                        remove_mean=True, path=None, block_size=64):
+  """
+  Compute the connectivity of every subject and stream it to a .npy file, one
+  subject at a time, so the cohort's connectivity never has to fit in RAM.
+
+  Args:
+    experiment (str) : Name of experiment
+    condition (None or str) : Condition whose frames are used, None for all
+    run (int) : 0-based run of the task
+    subjects (None or list of int) : 0-based subject IDs, None for all
+    remove_mean (bool) : If True, subtract the parcel-wise mean
+    path (None or str) : Output file, None for a file in CONNECTIVITY_DIR
+    block_size (int) : Number of parcels per block
+
+  Returns:
+    connectivity (n_subjects x n_pairs memmap): Read-only view of the file
+  """
+  if subjects is None:
+    subjects = range(N_SUBJECTS)
+  if path is None:
+    path = f"{CONNECTIVITY_DIR}/{experiment.upper()}_{condition or 'all'}_run{run}.npy"
+
+  parent = os.path.dirname(path)
+  if parent and not os.path.isdir(parent):
+    os.makedirs(parent)
+
+  bold_run = get_image_ids(experiment)[run]
+  n_pairs  = N_PARCELS * (N_PARCELS - 1) // 2
+  output   = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                       shape=(len(subjects), n_pairs))
+
+  for i, subject in enumerate(subjects):
+    ts     = load_single_timeseries(subject, bold_run, remove_mean)
+    frames = None
+    if condition is not None:
+      frames = get_condition_frames(subject, experiment, condition)[run]
+    output[i] = connectivity_features(ts, frames, block_size)
+
+  output.flush()
+  del output
+
+  return np.load(path, mmap_mode='r')
+
 # Subjects' information
 
 #Function: Get behavior of a single subject
@@ -524,14 +1922,15 @@ def subject_behavior(subject, feature=None):
 
     Raises:
       IndexError for invalid index.
+      KeyError for an ID that is not in SUBJECTS.
       NameError for invalid column's experiment
     
     Examples:
 
-    >>> subject_behavior(SUBJECTS[0], feature='Age')
+    >>> subject_behavior(subjects_str[0], feature='Age')
     '26-30'
 
-    >>> subject_behavior(SUBJECTS[0], feature=['Age', 'Gender'])
+    >>> subject_behavior(subjects_str[0], feature=['Age', 'Gender'])
     ['26-30', 'F']
 
     >>> subject_behavior(0, feature=['Age', 'Gender'])
@@ -540,11 +1939,13 @@ def subject_behavior(subject, feature=None):
   """
 
   # If a string is passed as the subject, retrieve subject's index
-  if type(subject) == str:
-    subject = ids_int.index(int(subject))
+  if isinstance(subject, str):
+    subject = SUBJECT_INDEX[int(subject)]
 
   # All of subject's behavior information.
-  subject_series = SUBJECTS_BEHAVIOR.iloc[subject]
+  subjects_behavior = get_subjects_behavior()
+  features          = subjects_behavior.columns
+  subject_series    = subjects_behavior.iloc[subject]
 
   if feature is None:
     return subject_series
@@ -563,50 +1964,92 @@ def subject_behavior(subject, feature=None):
 
   raise TypeError(f"Invalid type for 'feature', it should be str or list")
 
+#Function: Get behavior of many subjects in a single lookup
+
+def query_behavior(subjects=None, feature=None):
+  """
+  Get the behavior of many subjects in a single vectorised lookup.
+
+    Args:
+      subjects (None or list of int or list of str):
+            - None returns every subject, in the NMA-curated order
+            - ints correspond to subjects' indexes in the NMA-curated dataset
+            - strs correspond to subjects' IDs
+      feature (None or string or list of strings):
+            - None returns all columns
+            - string returns only one column as a pandas.Series
+            - list of strings returns all requested columns
+
+    Returns:
+      behavior (pandas.DataFrame or pandas.Series): One row per subject, in
+        the requested order
+
+    Raises:
+      KeyError for an ID that is not in SUBJECTS.
+      NameError for invalid column's experiment
+
+    Examples:
+
+    >>> query_behavior([0], ['Age', 'Gender']).values.tolist()
+    [['26-30', 'F']]
+
+    >>> query_behavior(subjects_str[:1], 'Gender').tolist()
+    ['F']
+  """
+  subjects_behavior = get_subjects_behavior()
+
+  rows = slice(None)
+  if subjects is not None:
+    rows = np.asarray(subjects)
+    if rows.dtype.kind in 'USO':
+      rows = np.array([SUBJECT_INDEX[int(i)] for i in rows], dtype=np.intp)
+
+  if feature is None:
+    return subjects_behavior.iloc[rows]
+
+  columns = subjects_behavior.columns.get_indexer(np.atleast_1d(feature))
+  if (columns < 0).any():
+    raise NameError(f"Feature '{feature}' is not a valid column.")
+
+  if isinstance(feature, str):
+    return subjects_behavior.iloc[rows, columns[0]]
+  return subjects_behavior.iloc[rows, columns]
+
 #Function: Get behavior of all subjects
 
 def all_subjects_behavior(subjects, behaviors, use_index=False):
 
-  all_behaviors = []
-
-  if use_index:
-    for i in subjects:
-      all_behaviors.append(subject_behavior(i, behaviors))
-      
-  else:
-    for i in range(len(subjects)):
-      all_behaviors.append(subject_behavior(i, behaviors))
+  rows     = subjects if use_index else range(len(subjects))
+  behavior = query_behavior(list(rows), behaviors)
 
-  return all_behaviors
+  if behaviors is None:
+    return [row for _, row in behavior.iterrows()]
+  return behavior.values.tolist()
 
 #Function: Get the indexes for female and male subjects.
 
 def gender_indexes():
 
-  females = [] 
-  males   = []
-  
-  for i, gender in enumerate(all_subjects_behavior(SUBJECTS, 'Gender')):
-    if gender == 'F':
-      females.append(i)
-    else:
-      males.append(i)
+  is_female = (query_behavior(feature='Gender') == 'F').to_numpy()
+
+  females = np.flatnonzero(is_female).tolist()
+  males   = np.flatnonzero(~is_female).tolist()
 
   return females, males
 
 #Function: Get a random selection of indexes for each gender
 #We need subsets of 150 females and males.
 
-def get_random_indexes():
+#With random_state set, the same subsets are drawn on every call.
+
+def get_random_indexes(random_state=None, n_subjects=150):
   
   females, males = gender_indexes()
 
-  # There are two male subjects with wrong BOLD readouts
-  males.remove(3)
-  males.remove(98)
+  sampler = random if random_state is None else random.Random(random_state)
 
-  females_150 = random.sample(females, 150)
-  males_150   = random.sample(males, 150)
+  females_150 = sampler.sample(females, n_subjects)
+  males_150   = sampler.sample(males, n_subjects)
 
   return females_150, males_150
 
@@ -614,6 +2057,10 @@ def get_random_indexes():
 
 def divide_by_gender(data, female_indexes, male_indexes):
 
+  # Dense data is split by indexing along the subject axis
+  if isinstance(data, (np.ndarray, BOLDTensor)):
+    return data[np.asarray(female_indexes)], data[np.asarray(male_indexes)]
+
   females = []
   for f in female_indexes:
     females.append(data[f])
@@ -624,339 +2071,1202 @@ def divide_by_gender(data, female_indexes, male_indexes):
 
   return females, males
 
-# Processing data
+# Model
+
+# Candidate classifiers of compare_models, by their PyCaret short names
+CLASSIFIERS = {'et':      'Extra Trees Classifier',
+               'rf':      'Random Forest Classifier',
+               'lr':      'Logistic Regression',
+               'svm':     'SVM - Linear Kernel',
+               'nb':      'Naive Bayes',
+               'xgboost': 'Extreme Gradient Boosting'}
+
+#Function: Build a classifier by its short name
 
-# Initialize data
-#experiment = "SOCIAL"
-#ts_social  = get_timeseries(experiment)
-#bold_data  = get_BOLD(ts_social, experiment)
+def make_classifier(name, random_state=0):
+  """
+  Build a classifier by its short name.
 
-# print("Original data . . . . . . . . . . . . . . . . . . . . . . . .\n")  # <--- Uncomment whole block to
-# print(f"bold_data has:   {len(bold_data)} subjects")                      #      understand the structure
-# print(f"subject_0 has:   {len(bold_data[0])} runs")
-# print(f"s0, 1st_run has: {len(bold_data[0][0])} conditions")
-# print(f"s0, 2nd_run has: {len(bold_data[0][1])} conditions")
-# print(f"s0r0, 'mental':  {bold_data[0][0][0].shape} (ROIs, timepoints)")
-# print(f"s0r0, 'rnd':     {bold_data[0][0][1].shape}")
-# print(f"s0r1, 'mental':  {bold_data[0][1][0].shape}")
-# print(f"s0r1, 'rnd':     {bold_data[0][1][1].shape}\n\n")
+  Args:
+    name (str) : One of CLASSIFIERS ('et', 'rf', 'lr', 'svm', 'nb', 'xgboost')
+    random_state (int) : Seed of the classifier
 
-#Data processed
+  Returns:
+    classifier : Unfitted scikit-learn estimator
+  """
+  if name == 'et':
+    from sklearn.ensemble import ExtraTreesClassifier
+    return ExtraTreesClassifier(n_estimators=100, random_state=random_state)
+  if name == 'rf':
+    from sklearn.ensemble import RandomForestClassifier
+    return RandomForestClassifier(n_estimators=100, random_state=random_state)
+  if name == 'lr':
+    from sklearn.linear_model import LogisticRegression
+    return LogisticRegression(max_iter=1000, random_state=random_state)
+  if name == 'svm':
+    from sklearn.svm import SVC
+    return SVC(kernel='linear', random_state=random_state)
+  if name == 'nb':
+    from sklearn.naive_bayes import GaussianNB
+    return GaussianNB()
+  if name == 'xgboost':
+    from xgboost import XGBClassifier
+    return XGBClassifier(n_estimators=100, random_state=random_state, n_jobs=1)
+  raise ValueError(f"Unknown classifier '{name}'")
+
+#Function: Build the scaling -> ANOVA selection -> classifier pipeline
+
+def make_pipeline(classifier='et', k='all', cache_dir=None, random_state=0):
+  """
+  Build the scaling -> ANOVA selection -> classifier pipeline, so that every
+  step is fitted on the training folds only.
 
-# Removing excess of timepoints in 'condition' with bigger size.
-# Also, returns only the data for the run that was reduced.
-reduced_data = remove_excess(bold_data, 0)
+  Args:
+    classifier (str or estimator) : Short name for make_classifier, or an estimator
+    k (int or 'all') : Number of regions kept by the ANOVA F-value
+    cache_dir (None or str) : If set, fitted scaling/selection steps are cached
+      there and reused by later fits on the same fold
+    random_state (int) : Seed of the classifier
 
-# print("After removing the excess . . . . . . . . . . . . . . . . . . .\n")  # <--- Uncomment whole block to
-# print(f"reduced_data has: {len(reduced_data)} subjects")                    #      understand the structure
-# print(f"subject_0 has:    {len(reduced_data[2])} conditions")
-# print(f"s0, 'mental':     {reduced_data[2][0].shape} (ROIs, timepoints)")
-# print(f"s0, 'rnb:         {reduced_data[2][1].shape}\n")
+  Returns:
+    pipeline (sklearn.pipeline.Pipeline)
+  """
+  from sklearn.pipeline import Pipeline
+  from sklearn.preprocessing import StandardScaler
+  from sklearn.feature_selection import SelectKBest, f_classif
 
-# Calculating BOLD signal's average for each region/subject, run 0
-average_BOLD = get_average_by_region(reduced_data)
+  if isinstance(classifier, str):
+    classifier = make_classifier(classifier, random_state)
 
-# print("BOLD signal's average for each region/subject, run 0 . . . . . .\n")  # <--- Uncomment whole block to
-# print(f"average_BOLD has: {len(average_BOLD)} subjects")                     #      understand the structure
-# print(f"subject_0 has:    {len(average_BOLD[0])} conditions")
-# print(f"s0, 'mental' has: {len(average_BOLD[0][0])} regions")
-# print(f"s0c0, 1st region: {average_BOLD[0][0][0]}")
-# print(f"s0c0,last region: {average_BOLD[0][0][359]}\n")
+  return Pipeline([('scale',  StandardScaler()),
+                   ('select', SelectKBest(f_classif, k=k)),
+                   ('model',  classifier)],
+                  memory=cache_dir)
 
-# Dividing subjects by gender.
-female_indexes, male_indexes = get_random_indexes()
-F_AVERAGE_BOLD, M_AVERAGE_BOLD = divide_by_gender(average_BOLD, female_indexes, male_indexes)
+#Function: Repeated stratified cross-validation with in-fold preprocessing
 
-# print("Dividing subjects by gender, run 0 . . . . . . . . . . . . . . . .\n")  # <--- Uncomment whole block to
-# print("Female's average for each region/subject")                              #      understand the structure
-# print(f"F_AVERAGE_BOLD has: {len(F_AVERAGE_BOLD)} subjects")
-# print(f"female_0 has:       {len(F_AVERAGE_BOLD[0])} conditions")
-# print(f"f0, 'mental' has:   {len(F_AVERAGE_BOLD[0][0])} regions")
-# print(f"f0c0,last region:   {F_AVERAGE_BOLD[0][0][359]}\n")
+@profile_stage
+def cross_validate_model(X, y, classifier='et', k='all', n_splits=5, n_repeats=1,
+                         n_jobs=-1, random_state=0, cache_dir=None):
+  """
+  Repeated stratified cross-validation with the preprocessing fitted inside
+  each fold, so test folds never leak into scaling or region selection.
 
-# Region's average for all subjects, by gender, run 0 
-F_AVERAGE_REGN = get_average_all_subjects(F_AVERAGE_BOLD)
-M_AVERAGE_REGN = get_average_all_subjects(M_AVERAGE_BOLD)
+  Args:
+    X (n_subjects x n_features array): Features, e.g. the mental-rnd differences
+    y (n_subjects array): Gender labels
+    classifier (str or estimator) : Short name for make_classifier, or an estimator
+    k (int or 'all') : Number of regions kept by the ANOVA F-value
+    n_splits (int) : Number of folds
+    n_repeats (int) : Number of repetitions with different splits
+    n_jobs (int) : Processes used to run the folds, -1 for every core
+    random_state (int) : Seed of the splits and of the classifier
+    cache_dir (None or str) : Cache of the fitted scaling/selection steps
 
-# print("Region's average for females, run 0 . . . . . . . . . . . . . . . .\n")  # <--- Uncomment whole block to
-# print(f"F_AVERAGE_REGN has: {len(F_AVERAGE_REGN)} conditions")                  #      understand the structure
-# print(f"condition_0 has:    {len(F_AVERAGE_REGN[0])} averages for each region")
-# print(f"c0, last region:    {F_AVERAGE_REGN[0][359]}")
+  Returns:
+    scores (n_splits * n_repeats array): Accuracy of every fold
+  """
+  from sklearn.preprocessing import Normalizer
+  from sklearn.model_selection import RepeatedStratifiedKFold, cross_val_score
 
-# Difference between conditions
-F_MENTAL_RND_DIFF = get_difference(F_AVERAGE_BOLD)
-M_MENTAL_RND_DIFF = get_difference(M_AVERAGE_BOLD)
+  # Normalizer works subject by subject, so it is the same in every fold:
+  # it is applied once, before splitting
+  X = Normalizer().fit_transform(X)
 
-print(f"F_MENTAL_RND_DIFF has: {len(F_MENTAL_RND_DIFF)} subjects")                  #      understand the structure
-print(f"female_0 has:          {len(F_MENTAL_RND_DIFF[0])} mental-rnd differences")
+  cv = RepeatedStratifiedKFold(n_splits=n_splits, n_repeats=n_repeats,
+                               random_state=random_state)
+  pipeline = make_pipeline(classifier, k, cache_dir, random_state)
+  return cross_val_score(pipeline, X, y, cv=cv, n_jobs=n_jobs)
 
-# Key lists from previous cell
+# Model comparison
 
-#F_AVERAGE_BOLD has the BOLD signal average for each female/region.
+#Function: Classification metrics of one fold, as reported by PyCaret
 
-#F_AVERAGE_BOLD[females]                              <-- 150 females
-#F_AVERAGE_BOLD[females][condition]                   <-- 2 conditions
-#F_AVERAGE_BOLD[females][condition][average_region]   <-- 360 regions averaged
+def fold_metrics(model, X_test, y_test):
+  from sklearn import metrics
 
-#Example
+  predicted = model.predict(X_test)
+  positive  = model.classes_[-1]
 
-print("Female 1,   'mental', region 360 = ", F_AVERAGE_BOLD[0][0][359])
-print("Female 150, 'rnd',    region 1   = ", F_AVERAGE_BOLD[149][1][0], "\n")
+  if hasattr(model, 'predict_proba'):
+    decision = model.predict_proba(X_test)[:, -1]
+  else:
+    decision = model.decision_function(X_test)
+
+  return {'Accuracy': metrics.accuracy_score(y_test, predicted),
+          'AUC':      metrics.roc_auc_score(y_test == positive, decision),
+          'Recall':   metrics.recall_score(y_test, predicted, pos_label=positive),
+          'Prec.':    metrics.precision_score(y_test, predicted, pos_label=positive,
+                                              zero_division=0),
+          'F1':       metrics.f1_score(y_test, predicted, pos_label=positive),
+          'Kappa':    metrics.cohen_kappa_score(y_test, predicted),
+          'MCC':      metrics.matthews_corrcoef(y_test, predicted)}
+
+#Function: Compare candidate classifiers on shared cross-validation splits
+
+@profile_stage
+def compare_models(X, y, candidates=tuple(CLASSIFIERS), k='all', n_splits=10,
+                   n_workers=None, time_budget=None, min_folds=3, margin=0.1,
+                   random_state=0):
+  """
+  Compare candidate classifiers with the same stratified folds, in the
+  format of PyCaret's compare_models leaderboard. Candidates run
+  concurrently, each fitting make_pipeline (scaling and ANOVA selection
+  inside the fold) fold by fold.
+
+  A candidate stops early once it has run min_folds folds and its mean
+  accuracy is more than margin below the best mean accuracy seen so far
+  over at least min_folds folds.
+  Once time_budget seconds have passed, no new fold is started; the
+  leaderboard then reports the folds that were completed. Candidates whose
+  library is not installed (e.g. xgboost) are skipped.
 
-# Same for M_AVERAGE_BOLD:
-# M_AVERAGE_BOLD[males][condition][average_region]
-#F_MENTAL_RND_DIFF has the 'mental' and 'rnd' difference (BOLD signal average per region/subject).
-#F_MENTAL_RND_DIFF[subject]                    <-- 150 females
-#F_MENTAL_RND_DIFF[subject][region_difference] <-- 360 regions averaged
+  Args:
+    X (n_subjects x n_features array): Features, e.g. the mental-rnd differences
+    y (n_subjects array): Gender labels
+    candidates (list of str): Short names of the classifiers (see CLASSIFIERS)
+    k (int or 'all') : Number of regions kept by the ANOVA F-value
+    n_splits (int) : Number of folds
+    n_workers (None or int): Candidates run at the same time (None: all)
+    time_budget (None or float): Seconds after which no new fold is started
+    min_folds (int) : Folds run by every candidate before it can be stopped
+    margin (float) : Accuracy gap to the leader that stops a candidate
+    random_state (int) : Seed of the splits and of the classifiers
 
-#Example:
+  Returns:
+    leaderboard (pd.DataFrame): Mean metrics per candidate, sorted by accuracy,
+      with the mean fit time per fold in 'TT (Sec)'
+  """
+  from sklearn.preprocessing import Normalizer
+  from sklearn.model_selection import StratifiedKFold
+
+  X = Normalizer().fit_transform(X)
+  y = np.asarray(y)
+  splits = list(StratifiedKFold(n_splits=n_splits, shuffle=True,
+                                random_state=random_state).split(X, y))
+
+  start  = time.perf_counter()
+  lock   = threading.Lock()
+  leader = [0.0]
+
+  def run_candidate(name):
+    try:
+      pipeline = make_pipeline(name, k, random_state=random_state)
+    except ImportError as error:
+      print(f"Skipping '{name}': {error}")
+      return None
+
+    rows, fit_time = [], 0.0
+    for train, test in splits:
+      if time_budget is not None and time.perf_counter() - start > time_budget:
+        break
+      tic = time.perf_counter()
+      pipeline.fit(X[train], y[train])
+      fit_time += time.perf_counter() - tic
+      rows.append(fold_metrics(pipeline, X[test], y[test]))
+
+      accuracy = np.mean([row['Accuracy'] for row in rows])
+      # Only means over min_folds folds or more can set the bar, so one
+      # lucky fold does not stop a better candidate
+      with lock:
+        if len(rows) >= min_folds:
+          leader[0] = max(leader[0], accuracy)
+        hopeless = len(rows) >= min_folds and accuracy < leader[0] - margin
+      if hopeless:
+        break
+
+    if not rows:
+      return None
+    result = pd.DataFrame(rows).mean()
+    result['TT (Sec)'] = fit_time / len(rows)
+    result['Model'] = CLASSIFIERS.get(name, name)
+    return name, result
+
+  with ThreadPoolExecutor(n_workers or len(candidates)) as executor:
+    results = [result for result in executor.map(run_candidate, candidates) if result]
+
+  leaderboard = pd.DataFrame({name: result for name, result in results}).T
+  columns = ['Model', 'Accuracy', 'AUC', 'Recall', 'Prec.', 'F1', 'Kappa', 'MCC', 'TT (Sec)']
+  leaderboard = leaderboard[columns].sort_values('Accuracy', ascending=False)
+  return leaderboard.astype({c: float for c in columns[1:]})
+
+# ANOVA threshold sweep
+
+#Function: Regions sorted by decreasing ANOVA F-value
+
+def anova_order(X, y):
+  """
+  Compute the ANOVA F-value of every region once and sort them, so any
+  threshold or top-k selection is a prefix of the same order.
 
-print("Female 1,   region 360 = ", F_MENTAL_RND_DIFF[0][359])
-print("Female 150, region 1   = ", F_MENTAL_RND_DIFF[1][0], "\n")
-print(type(F_MENTAL_RND_DIFF))
-print(type(F_MENTAL_RND_DIFF[0]))
-print(type(F_MENTAL_RND_DIFF[0][0]), "\n")
+  Args:
+    X (n_subjects x n_features array): Features
+    y (n_subjects array): Gender labels
 
-np_F_MENTAL_RND_DIFF = np.array(F_MENTAL_RND_DIFF)
-np_M_MENTAL_RND_DIFF = np.array(M_MENTAL_RND_DIFF)
+  Returns:
+    f_sorted (n_features array): F-values in decreasing order
+    order (n_features array): Region codes in the same order
+  """
+  from sklearn.feature_selection import f_classif
 
-print(type(np_F_MENTAL_RND_DIFF))
-print(type(np_F_MENTAL_RND_DIFF[0]))
-print(type(np_F_MENTAL_RND_DIFF[0][0]))
+  f_values = np.nan_to_num(f_classif(X, y)[0])
+  order = np.argsort(f_values, kind='stable')[::-1]
+  return f_values[order], order
 
-# Same for M_MENTAL_RND_DIFF
+#Function: Number of regions above each F-value threshold
 
-#List with original genders
+def count_above(f_sorted, thresholds):
+  # f_sorted is decreasing, so its negation is increasing
+  return np.searchsorted(-f_sorted, -np.asarray(thresholds, dtype=float), side='left')
 
-# From a previous cell, you have the lists female_indexes and male_indexes
-# these two have the index for each female and male in the original list.
-# Let's combine female_indexes and male_indexes so you have one list. 
-# NOTE: these indexes were selected randomly.
+#Function: Codes of the regions above each F-value threshold
 
-both_indexes = female_indexes + male_indexes
-both_indexes.sort()
-print(both_indexes)
+@profile_stage
+def regions_above(X, y, thresholds):
+  """
+  Codes of the regions with an ANOVA F-value above each threshold, sorted by
+  decreasing F-value. The F-values are computed and sorted once.
 
-# Now we're going to look for their gender.
-current_subjects_gender = all_subjects_behavior(both_indexes, 'Gender', use_index=True)
-print(current_subjects_gender)
+  Args:
+    X (n_subjects x n_features array): Features
+    y (n_subjects array): Gender labels
+    thresholds (list of floats): F-value thresholds
 
-# Model
+  Returns:
+    regions (dict): threshold -> array of region codes (a view of one order)
+    f_sorted (n_features array): F-values in decreasing order
+  """
+  f_sorted, order = anova_order(X, y)
+  counts = count_above(f_sorted, thresholds)
+  return {t: order[:n] for t, n in zip(thresholds, counts)}, f_sorted
+
+#Function: Accuracy of every grid point on one fold
 
-#@title PyCaret
-!pip install pycaret
+def sweep_fold(X, y, train, test, thresholds, top_k, classifier, random_state):
+  from sklearn.base import clone
+  from sklearn.preprocessing import StandardScaler
 
-#@title Libraries
-from pycaret.classification import *
-from xgboost import XGBClassifier
-from sklearn import datasets, svm
-from sklearn.ensemble import ExtraTreesClassifier
-from sklearn.decomposition import PCA
-from sklearn.naive_bayes import GaussianNB
-from sklearn.feature_selection import SelectKBest, f_classif
-from sklearn.preprocessing import Normalizer, StandardScaler
-from sklearn.model_selection import train_test_split, cross_validate, cross_val_score
-from sklearn.linear_model import LogisticRegression
+  scaler  = StandardScaler().fit(X[train])
+  X_train = scaler.transform(X[train])
+  X_test  = scaler.transform(X[test])
 
-# Prepare data
+  # Sort the columns by F-value once: every selection is then a prefix view
+  f_sorted, order = anova_order(X_train, y[train])
+  X_train = X_train[:, order]
+  X_test  = X_test[:, order]
 
-# Initial input data.
+  if thresholds is not None:
+    ks = count_above(f_sorted, thresholds)
+  else:
+    ks = np.minimum(top_k, X.shape[1])
+
+  model  = make_classifier(classifier, random_state)
+  scores = np.full(len(ks), np.nan)
+  for i, k in enumerate(ks):
+    if k == 0:
+      continue
+    fitted = clone(model).fit(X_train[:, :k], y[train])
+    scores[i] = fitted.score(X_test[:, :k], y[test])
+  return ks, scores
+
+#Function: Cross-validated accuracy over a grid of F-value thresholds or top-k
+
+@profile_stage
+def threshold_sweep(X, y, thresholds=None, top_k=None, classifier='et', n_splits=5,
+                    n_repeats=1, n_jobs=-1, random_state=0):
+  """
+  Cross-validated accuracy for a whole grid of ANOVA F-value thresholds (or of
+  top-k region counts) in one pass. On each fold the regions are scaled and
+  ranked once, and every grid point is fitted on a prefix view of the same
+  column-sorted matrix. Folds run in parallel.
 
-# X_vector should be the data (BOLD averages) of both genders.
-BOLD_DATA = np.vstack((np_F_MENTAL_RND_DIFF, np_M_MENTAL_RND_DIFF))
+  Args:
+    X (n_subjects x n_features array): Features, e.g. the mental-rnd differences
+    y (n_subjects array): Gender labels
+    thresholds (list of floats): F-value thresholds (e.g. [2, 3, 4, 5])
+    top_k (list of ints): Numbers of regions, used if thresholds is None
+    classifier (str) : Short name for make_classifier
+    n_splits (int) : Number of folds
+    n_repeats (int) : Number of repetitions with different splits
+    n_jobs (int) : Processes used to run the folds, -1 for every core
+    random_state (int) : Seed of the splits and of the classifier
 
-# Y_vector should be the gender labels.
-LABELS = np.array(['F'] * 150 + ['M'] * 150)
+  Returns:
+    results (pd.DataFrame): One row per grid point, with the mean number of
+      regions kept and the mean and std of the accuracy over the folds
+  """
+  from joblib import Parallel, delayed
+  from sklearn.preprocessing import Normalizer
+  from sklearn.model_selection import RepeatedStratifiedKFold
 
-# Split the data into training and test sets
+  if (thresholds is None) == (top_k is None):
+    raise ValueError("Give exactly one of thresholds and top_k")
 
-X_train, X_test, y_train, y_test = train_test_split(BOLD_DATA,
-                                                    LABELS, 
-                                                    test_size = 0.1, 
-                                                    random_state=0)
-print(X_train.shape, X_test.shape)
-print(y_train.shape, "\t  ", y_test.shape)
+  X = Normalizer().fit_transform(X)
+  y = np.asarray(y)
+  cv = RepeatedStratifiedKFold(n_splits=n_splits, n_repeats=n_repeats,
+                               random_state=random_state)
 
-# Scale and normalize the data
+  folds = Parallel(n_jobs=n_jobs)(
+      delayed(sweep_fold)(X, y, train, test, thresholds, top_k, classifier, random_state)
+      for train, test in cv.split(X, y))
 
-normal = Normalizer()
-scaler = StandardScaler()
+  ks     = np.array([k for k, _ in folds])
+  scores = np.array([score for _, score in folds])
 
-X_train = normal.fit_transform(X_train)
-X_train = scaler.fit_transform(X_train)
+  grid = pd.Index(thresholds if thresholds is not None else top_k,
+                  name='threshold' if thresholds is not None else 'top_k')
+  return pd.DataFrame({'n_regions': ks.mean(axis=0),
+                       'mean':      np.nanmean(scores, axis=0),
+                       'std':       np.nanstd(scores, axis=0)}, index=grid)
 
-X_test = normal.fit_transform(X_test)
-X_test = scaler.fit_transform(X_test)
+# Bootstrap resampling
 
-print(X_train.shape, X_test.shape)
+#Function: Cross-validated accuracy of one balanced resample
 
-# Frame with the training data and label
+def resample_score(X, female_indexes, male_indexes, classifier, k, n_splits, seed):
+  from sklearn.model_selection import StratifiedKFold, cross_val_score
 
-DF_TRAINING = pd.DataFrame(X_train)
-DF_TRAINING['Label'] = y_train
-DF_TRAINING.head()
+  # The resample is an index selection of the features of every subject
+  indexes = np.concatenate((female_indexes, male_indexes))
+  labels  = np.array(['F'] * len(female_indexes) + ['M'] * len(male_indexes))
 
-# Identifying most relevant ROI for the experiment.
+  cv = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed)
+  return cross_val_score(make_pipeline(classifier, k, random_state=seed),
+                         X[indexes], labels, cv=cv, n_jobs=1).mean()
 
-#Since we have more features (360 regions) than variables (300 subjects) we need to select the most relevant ones. We do this by computing the ANOVA F-value for the provided sample.
+#Function: Distribution of the accuracy over balanced random subsamples
 
-# Computing the ANOVA F-value
-relevant = f_classif(X_train, y_train)
-relevant_feat = pd.Series(relevant[0], DF_TRAINING.columns[:len(DF_TRAINING.columns)-1])
+@profile_stage
+def bootstrap_scores(features, n_resamples=100, n_subjects=150, classifier='et', k='all',
+                     n_splits=5, n_jobs=-1, random_state=0, confidence=0.95):
+  """
+  Repeat the balanced subsample -> cross-validation of main() many times, to
+  estimate how much the accuracy depends on the subjects drawn by
+  get_random_indexes. The features of every subject are computed once (e.g.
+  with cached_features); each resample only selects rows of them. Resamples
+  run in parallel, each with its own seed derived from random_state.
 
+  Args:
+    features (N_SUBJECTS x n_features array): Features of every subject
+    n_resamples (int) : Number of balanced subsamples
+    n_subjects (int) : Subjects of each gender in a subsample
+    classifier (str) : Short name for make_classifier
+    k (int or 'all') : Number of regions kept by the ANOVA F-value
+    n_splits (int) : Number of folds of the cross-validation
+    n_jobs (int) : Processes used to run the resamples, -1 for every core
+    random_state (int) : Seed of the subsamples, splits and classifiers
+    confidence (float) : Coverage of the percentile confidence interval
 
-# Codes for the relevant regions with a F-value above 2
-roi_index_2 = [i for i,f in enumerate(relevant_feat) if f > 2]
-roi_above_2 = [ROIs[i] for i in roi_index_2]
+  Returns:
+    scores (n_resamples array): Mean cross-validated accuracy of every resample
+    interval (tuple): Lower and upper bounds of the confidence interval
+  """
+  from joblib import Parallel, delayed
+  from sklearn.preprocessing import Normalizer
 
-print(f"There are {len(roi_above_2)} regions with " +
-      f"a F-value higher than 2:\n{roi_above_2}\n")
+  X = Normalizer().fit_transform(features)
 
+  seeds = np.random.SeedSequence(random_state).generate_state(n_resamples)
+  resamples = [get_random_indexes(int(seed), n_subjects) for seed in seeds]
 
-# Codes for the relevant regions with a F-value above 3
-roi_index_3 = [i for i,f in enumerate(relevant_feat) if f > 3]
-roi_above_3 = [ROIs[i] for i in roi_index_3]
+  scores = np.array(Parallel(n_jobs=n_jobs)(
+      delayed(resample_score)(X, females, males, classifier, k, n_splits, int(seed))
+      for (females, males), seed in zip(resamples, seeds)))
 
-print(f"There are {len(roi_above_3)} regions with " +
-      f"a F-value higher than 3:\n{roi_above_3}\n")
+  tail = (1 - confidence) / 2 * 100
+  interval = tuple(np.percentile(scores, [tail, 100 - tail]).tolist())
+  return scores, interval
 
+# Permutation test
 
-# Codes for the relevant regions with a F-value above 4
-roi_index_4 = [i for i,f in enumerate(relevant_feat) if f > 4]
-roi_above_4 = [ROIs[i] for i in roi_index_4]
+#Function: Accuracy of a ridge classifier for many label permutations at once
 
-print(f"There are {len(roi_above_4)} regions with " +
-      f"a F-value higher than 4:\n{roi_above_4}\n")
+def ridge_permutation_scores(X, labels, splits, alpha=1.0):
+  """
+  Cross-validated accuracy of a ridge (least-squares) classifier for many
+  label vectors at once. For each fold, the closed-form fit is folded into a
+  single (n_test x n_train) matrix, so every permutation costs one product.
 
+  Args:
+    X (n_subjects x n_features array): Features
+    labels (n_subjects x n_labels array): +1/-1 labels, one column per permutation
+    splits (list of (train, test) index arrays): Cross-validation folds
+    alpha (float) : Ridge regularisation strength
 
-# Codes for the relevant regions with a F-value above 5
-roi_index_5 = [i for i,f in enumerate(relevant_feat) if f > 5]
-roi_above_5 = [ROIs[i] for i in roi_index_5]
+  Returns:
+    scores (n_labels array): Mean accuracy over the folds, per column of labels
+  """
+  scores = np.zeros(labels.shape[1])
 
-print(f"There are {len(roi_above_5)} regions with " +
-      f"a F-value higher than 5:\n{roi_above_5}\n")
+  for train, test in splits:
+    # Standardise with the training fold (independent of the labels)
+    mean = X[train].mean(axis=0)
+    std  = X[train].std(axis=0)
+    std[std == 0] = 1
+    X_train = (X[train] - mean) / std
+    X_test  = (X[test] - mean) / std
 
-# Select relevant features from the data
+    # Dual ridge solution: predictions = X_test X_train' (K + alpha I)^-1 (y - mean(y)) + mean(y)
+    gram = X_train @ X_train.T
+    hat  = np.linalg.solve(gram + alpha * np.eye(len(train)), X_train @ X_test.T).T
 
-TRAINING_ABOVE_2 = DF_TRAINING.filter(roi_index_2, axis=1)
-TRAINING_ABOVE_2['Label']= DF_TRAINING['Label']
+    y_train = labels[train]
+    offset  = y_train.mean(axis=0)
+    predictions = hat @ (y_train - offset) + offset
 
-TRAINING_ABOVE_3 = DF_TRAINING.filter(roi_index_3, axis=1)
-TRAINING_ABOVE_3['Label']= DF_TRAINING['Label']
+    scores += (np.sign(predictions) == labels[test]).mean(axis=0)
 
-TRAINING_ABOVE_4 = DF_TRAINING.filter(roi_index_4, axis=1)
-TRAINING_ABOVE_4['Label']= DF_TRAINING['Label']
+  return scores / len(splits)
 
-TRAINING_ABOVE_5 = DF_TRAINING.filter(roi_index_5, axis=1)
-TRAINING_ABOVE_5['Label']= DF_TRAINING['Label']
+#Function: Accuracy of a pipeline for one label permutation
 
-# Finding the best model for our data
+def permuted_score(X, y, splits, classifier, k, seed):
+  from sklearn.model_selection import cross_val_score
 
-# Data with F-value > 2.
-#setup(data = TRAINING_ABOVE_2, target = 'Label')
-#compare_models()
-#model = create_model('et')
-#tune_model(model)
+  y_permuted = np.random.default_rng(seed).permutation(y)
+  return cross_val_score(make_pipeline(classifier, k, random_state=0), X, y_permuted,
+                         cv=splits, n_jobs=1).mean()
 
-# Data with F-value > 3
+#Function: Permutation test of the cross-validated gender classification accuracy
 
-setup(data = TRAINING_ABOVE_3, target = 'Label')
+@profile_stage
+def permutation_test(X, y, classifier='ridge', n_permutations=10000, n_splits=5, k='all',
+                     alpha=1.0, n_jobs=-1, random_state=0, batch_size=1000):
+  """
+  Permutation test of the cross-validated F vs M classification accuracy.
 
-compare_models()
+  With classifier='ridge', a closed-form ridge classifier on every feature is
+  fitted for batches of permutations at once (see ridge_permutation_scores).
+  Any other classifier (e.g. 'et', 'lr') runs the make_pipeline pipeline on a
+  process pool, one permutation per task, with per-permutation seeds derived
+  from random_state so results are reproducible.
 
-model = create_model('et')
-tune_model(model)
+  Args:
+    X (n_subjects x n_features array): Features
+    y (n_subjects array): Gender labels
+    classifier (str) : 'ridge', or a short name for make_classifier
+    n_permutations (int) : Number of label permutations
+    n_splits (int) : Number of stratified folds (fixed across permutations)
+    k (int or 'all') : Regions kept by the ANOVA F-value (pipeline classifiers only)
+    alpha (float) : Ridge regularisation strength
+    n_jobs (int) : Processes used by pipeline classifiers, -1 for every core
+    random_state (int) : Seed of the splits and the permutations
+    batch_size (int) : Permutations solved together by the ridge classifier
 
-# Data with F-value > 4
+  Returns:
+    score (float): Accuracy with the true labels
+    null_scores (n_permutations array): Accuracy with permuted labels
+    pvalue (float): (number of null scores >= score + 1) / (n_permutations + 1)
+  """
+  from sklearn.preprocessing import Normalizer
+  from sklearn.model_selection import StratifiedKFold
 
-setup(data = TRAINING_ABOVE_4, target = 'Label')
+  X = Normalizer().fit_transform(X)
+  y = np.asarray(y)
+  splits = list(StratifiedKFold(n_splits=n_splits, shuffle=True,
+                                random_state=random_state).split(X, y))
 
-compare_models()
+  if classifier == 'ridge':
+    classes = np.unique(y)
+    signs   = np.where(y == classes[-1], 1.0, -1.0)
+    rng     = np.random.default_rng(random_state)
 
-model = create_model('et')
-tune_model(model)
+    score = ridge_permutation_scores(X, signs[:, None], splits, alpha)[0]
 
-# Data with F-value > 5
+    null_scores = []
+    for start in range(0, n_permutations, batch_size):
+      n_batch  = min(batch_size, n_permutations - start)
+      permuted = rng.permuted(np.tile(signs, (n_batch, 1)), axis=1).T
+      null_scores.append(ridge_permutation_scores(X, permuted, splits, alpha))
+    null_scores = np.concatenate(null_scores)
 
-setup(data = TRAINING_ABOVE_5, target = 'Label')
+  else:
+    from joblib import Parallel, delayed
+    from sklearn.model_selection import cross_val_score
 
-compare_models()
+    score = cross_val_score(make_pipeline(classifier, k, random_state=0), X, y,
+                            cv=splits, n_jobs=n_jobs).mean()
 
-model = create_model('rf')
-tune_model(model)
+    seeds = np.random.SeedSequence(random_state).spawn(n_permutations)
+    null_scores = np.array(Parallel(n_jobs=n_jobs)(
+        delayed(permuted_score)(X, y, splits, classifier, k, seed) for seed in seeds))
 
-# Cross-validation to check model's accuracy
+  pvalue = (np.sum(null_scores >= score) + 1) / (n_permutations + 1)
+  return score, null_scores, pvalue
 
-# Remove less relevant features from train and test data **(run just once)
+#Function: Plot the null distribution of a permutation test
 
-#delete_columns = [i for i in range(360) if i not in roi_index_4]
-#X_train = np.delete(X_train, delete_columns, 1)
-#X_test  = np.delete(X_test,  delete_columns, 1)
+def plot_null_distribution(score, null_scores, pvalue, ax=None):
+  import matplotlib.pyplot as plt
 
-# Cross-validation: Extra Trees Classifier
+  if ax is None:
+    _, ax = plt.subplots()
 
-model  = ExtraTreesClassifier(n_estimators=100, random_state=0)
-scores = cross_val_score(model, X_train, y_train, cv=5)
+  ax.hist(null_scores, bins=20, density=True)
+  ax.axvline(score, ls='--', color='r')
+  score_label = (f"Score on original\ndata: {score:.2f}\n"
+                 f"(p-value: {pvalue:.3f})")
+  ax.text(0.05, 0.95, score_label, fontsize=12, transform=ax.transAxes, va='top')
+  ax.set_xlabel("Accuracy score")
+  ax.set_ylabel("Probability")
+  return ax
 
-print(scores.mean(), scores.std())
+# Incremental training
 
-# Test the data
+class IncrementalModel:
+  """
+  Normalizer -> scaling -> ANOVA selection -> ridge classifier, fitted from
+  running sufficient statistics instead of the feature matrix, so new
+  subjects can be added without revisiting the old ones.
+
+  For each class it keeps the number of subjects, the mean features and the
+  scatter matrix (sum of outer products around the class mean), merged
+  batch by batch with the parallel-variance update. The overall means and
+  variances (scaling), the ANOVA F-values (selection) and the normal
+  equations of the ridge classifier all follow from these, so update() costs
+  O(batch x n_features^2) and fit() O(n_features^3), whatever the cohort size.
+
+  With the same data, the result matches
+  make_pipeline(RidgeClassifier(alpha), k) on Normalizer-ed features.
+
+  Attributes:
+    classes (tuple): The two labels; the second one is the positive class
+    k (int or 'all'): Number of regions kept by the ANOVA F-value
+    alpha (float): Ridge regularisation strength
+    count (2 array): Subjects seen per class
+    mean (2 x n_features array): Mean features per class
+    scatter (2 x n_features x n_features array): Scatter matrix per class
+    selected, center, scale, coef, intercept : Set by fit()
+
+  Structure:
+    model = IncrementalModel(k=40).update(X, y).fit()
+    model.update(X_new, y_new).fit()
+    model.predict(X_test)
+  """
 
-model = ExtraTreesClassifier(n_estimators=100, random_state=0).fit(X_train, y_train)
-model.score(X_test, y_test)
+  __slots__ = ('classes', 'k', 'alpha', 'count', 'mean', 'scatter',
+               'selected', 'center', 'scale', 'coef', 'intercept')
+
+  def __init__(self, n_features=N_PARCELS, classes=('F', 'M'), k='all', alpha=1.0):
+    self.classes = tuple(classes)
+    self.k       = k
+    self.alpha   = alpha
+    self.count   = np.zeros(2, dtype=np.int64)
+    self.mean    = np.zeros((2, n_features))
+    self.scatter = np.zeros((2, n_features, n_features))
+    self.coef    = None
+
+  @staticmethod
+  def normalize(X):
+    # Same as sklearn's Normalizer: every subject scaled to unit norm
+    X = np.asarray(X, dtype=np.float64)
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return X / norms
+
+  def update(self, X, y):
+    """
+    Add subjects to the running statistics.
 
-# Permutation test
+    Args:
+      X (n_new x n_features array): Features of the new subjects
+      y (n_new array): Their labels, from classes
 
-# # PERMUTATION TESTING
+    Returns:
+      self
+    """
+    X = self.normalize(X)
+    y = np.asarray(y)
+
+    for c, label in enumerate(self.classes):
+      batch = X[y == label]
+      n_batch = len(batch)
+      if n_batch == 0:
+        continue
+
+      batch_mean = batch.mean(axis=0)
+      centered   = batch - batch_mean
+      n_old      = self.count[c]
+      n_total    = n_old + n_batch
+      delta      = batch_mean - self.mean[c]
+
+      # Merge the batch into the class moments (Chan et al.)
+      self.scatter[c] += centered.T @ centered
+      self.scatter[c] += np.outer(delta, delta) * (n_old * n_batch / n_total)
+      self.mean[c]    += delta * (n_batch / n_total)
+      self.count[c]    = n_total
+
+    return self
+
+  def moments(self):
+    """
+    Overall mean and scatter matrix of every subject seen so far.
 
-# generate some random feature data that are uncorrelated with the 
-# class labels in the dataset
+    Returns:
+      mean (n_features array)
+      scatter (n_features x n_features array)
+    """
+    n    = self.count.sum()
+    mean = self.count @ self.mean / n
+    between = self.mean - mean
+    scatter = self.scatter.sum(axis=0) + (between.T * self.count) @ between
+    return mean, scatter
+
+  def f_values(self):
+    """
+    ANOVA F-value of every feature, as f_classif on the subjects seen so far.
 
-# import numpy as np
-# from sklearn.model_selection import permutation_test_score
-# from sklearn.model_selection import StratifiedKFold
+    Returns:
+      f (n_features array)
+    """
+    n    = self.count.sum()
+    mean = self.count @ self.mean / n
+    between = self.count @ (self.mean - mean) ** 2
+    within  = np.einsum('cii->i', self.scatter)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      return np.nan_to_num(between / (within / (n - 2)))
+
+  def fit(self):
+    """
+    Refit the scaling, the region selection and the ridge classifier from the
+    running statistics.
+
+    Returns:
+      self
+    """
+    n = self.count.sum()
+    mean, scatter = self.moments()
+
+    f = self.f_values()
+    if self.k == 'all':
+      selected = np.arange(len(f))
+    else:
+      selected = np.sort(np.argsort(f, kind='stable')[::-1][:self.k])
 
-# n_uncorrelated_features = 2200
-# rng = np.random.RandomState(seed=0)
-# # use same number of samples as in the dataset and 2200 features
-# X_rand = rng.normal(size=(X.shape[0], n_uncorrelated_features))
+    # Standardisation, as StandardScaler (constant features are left unscaled)
+    scale = np.sqrt(np.diag(scatter)[selected] / n)
+    scale[scale == 0] = 1
 
-# clf_lr = LogisticRegression(penalty='l2', max_iter=1000)
+    # Labels are -1/+1: their centred cross-products with the features are
+    # sum_c n_c y_c (mean_c - mean)
+    signs = np.array([-1.0, 1.0])
+    cross = ((self.mean[:, selected] - mean[selected]).T * self.count) @ signs
 
-# score_iris, perm_scores_iris, pvalue_iris = permutation_test_score(
-#     clf_lr, X, y, n_permutations=100)
+    gram = scatter[np.ix_(selected, selected)] / np.outer(scale, scale)
+    gram[np.diag_indices_from(gram)] += self.alpha
+    self.coef = np.linalg.solve(gram, cross / scale)
 
-# score_rand, perm_scores_rand, pvalue_rand = permutation_test_score(
-#     clf_lr, X_rand, y, scoring="accuracy", cv=cv, n_permutations=100)
+    self.selected  = selected
+    self.center    = mean[selected]
+    self.scale     = scale
+    self.intercept = self.count @ signs / n
+    return self
 
-# import matplotlib.pyplot as plt
+  def decision_function(self, X):
+    X = self.normalize(X)[:, self.selected]
+    return (X - self.center) / self.scale @ self.coef + self.intercept
+
+  def predict(self, X):
+    return np.asarray(self.classes)[(self.decision_function(X) > 0).astype(int)]
+
+  def score(self, X, y):
+    return np.mean(self.predict(X) == np.asarray(y))
+
+# Precision check
+
+#Function: Check that float32 processing leaves the classification unchanged
+
+def validate_precision(experiment, run=0, subjects=None, labels=None, classifier='lr',
+                       k='all', n_splits=5, random_state=0, dtype=np.float32):
+  """
+  Compute the features of an experiment in float64 and in reduced precision,
+  and cross-validate the same classifier on both with the same folds. The
+  classification is unchanged when every subject gets the same prediction.
 
-# fig, ax = plt.subplots()
+  Args:
+    experiment (str) : Name of experiment
+    run (int) : 0-based run of the task
+    subjects (None or list of int) : 0-based subject IDs, None for all
+    labels (None or n_subjects array) : Labels, None for the subjects' gender
+    classifier (str) : Short name for make_classifier
+    k (int or 'all') : Number of regions kept by the ANOVA F-value
+    n_splits (int) : Number of folds
+    random_state (int) : Seed of the splits and of the classifier
+    dtype (dtype) : Reduced precision to check
+
+  Returns:
+    report (dict): max_abs_diff and max_rel_diff of the features, accuracy
+      in float64 and in dtype, agreement (fraction of identical predictions)
+      and unchanged (True if every prediction is identical)
+  """
+  global DTYPE
+  from sklearn.preprocessing import Normalizer
+  from sklearn.model_selection import StratifiedKFold, cross_val_predict
+
+  if labels is None:
+    labels = query_behavior(subjects, feature='Gender').to_numpy()
+  labels = np.asarray(labels)
+
+  precision = DTYPE
+  try:
+    DTYPE = np.dtype(np.float64)
+    features_64 = get_features(experiment, run, subjects)
+    DTYPE = np.dtype(dtype)
+    features_32 = get_features(experiment, run, subjects)
+  finally:
+    DTYPE = precision
+
+  diff  = np.abs(features_32.astype(np.float64) - features_64)
+  scale = np.abs(features_64).max()
+
+  cv = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+  predictions = []
+  for features in (features_64, features_32):
+    X = Normalizer().fit_transform(features)
+    predictions.append(cross_val_predict(make_pipeline(classifier, k, random_state=random_state),
+                                         X, labels, cv=cv))
+
+  agreement = np.mean(predictions[0] == predictions[1])
+  return {'max_abs_diff':      float(diff.max()),
+          'max_rel_diff':      float(diff.max() / scale) if scale else 0.0,
+          'accuracy':          float(np.mean(predictions[0] == labels)),
+          'accuracy_reduced':  float(np.mean(predictions[1] == labels)),
+          'agreement':         float(agreement),
+          'unchanged':         bool(agreement == 1)}
+
+# Model artifact and prediction
+
+# Version of the artifact layout written by save_model
+MODEL_FORMAT = 2
+
+#Function: Save a fitted model with everything needed to score new subjects
+
+def save_model(path, model, experiment, conditions=None, run=0, remove_mean=True):
+  """
+  Save a fitted model as a single artifact that scores raw subject
+  directories without the training cohort (see predict).
+
+  A fitted make_pipeline pipeline is stored behind a Normalizer step, so the
+  artifact holds the whole preprocessing: Normalizer, fitted StandardScaler
+  parameters, the selected regions and the classifier. An IncrementalModel
+  already normalises its input and is stored as it is.
+
+  Args:
+    path (str) : Location of the artifact (a joblib file)
+    model : Fitted make_pipeline pipeline, expecting Normalizer-ed features,
+      or a fitted IncrementalModel
+    experiment (str) : Name of the experiment the features come from
+    conditions (None or list of str) : The two conditions, None for CONDITIONS
+    run (int) : 0-based run of the task
+    remove_mean (bool) : If the parcel-wise mean was subtracted
+
+  Returns:
+    path (str)
+  """
+  import joblib
+  from sklearn.pipeline import Pipeline
+  from sklearn.preprocessing import Normalizer
 
-# ax.hist(perm_scores_iris, bins=20, density=True)
-# ax.axvline(score_iris, ls='--', color='r')
-# score_label = (f"Score on original\ndata: {score_iris:.2f}\n"
-#                f"(p-value: {pvalue_iris:.3f})")
-# ax.text(0.7, 260, score_label, fontsize=12)
-# ax.set_xlabel("Accuracy score")
-# _ = ax.set_ylabel("Probability")
+  if isinstance(model, IncrementalModel):
+    roi_index = model.selected
+  else:
+    if 'select' in model.named_steps:
+      roi_index = model.named_steps['select'].get_support(indices=True)
+    else:
+      roi_index = np.arange(model.n_features_in_)
+    model = Pipeline([('normalize', Normalizer())] + model.steps)
+
+  artifact = {'format':      MODEL_FORMAT,
+              'dtype':       DTYPE.str,
+              'model':       model,
+              'roi_index':   np.asarray(roi_index),
+              'spec':        FeatureSpec(experiment, conditions or CONDITIONS, run),
+              'remove_mean': remove_mean}
+
+  # Write next to the target and rename, so a partial artifact is never loaded
+  os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+  joblib.dump(artifact, f"{path}.part")
+  os.replace(f"{path}.part", path)
+  return path
+
+#Function: Load a model artifact written by save_model
+
+def load_model(path):
+  import joblib
+
+  artifact = joblib.load(path)
+  if artifact.get('format') != MODEL_FORMAT:
+    raise ValueError(f"{path} is not a model artifact of format {MODEL_FORMAT}")
+  return artifact
+
+#Function: Features of a subject directory outside of HCP_DIR
+
+def subject_dir_features(subject_dir, spec, remove_mean=True, dtype=None):
+  """
+  Compute one feature of a subject stored in its own directory, with the
+  HCP layout (timeseries/bold<run>_*.npy and EVs/<task>/<condition>.txt),
+  through the same loaders as the training features.
+
+  Args:
+    subject_dir (str) : Directory of the subject
+    spec (FeatureSpec) : Feature to compute
+    remove_mean (bool) : If True, subtract the parcel-wise mean
+    dtype (None or dtype) : Precision of the computation, None uses DTYPE
+
+  Returns:
+    features (n_parcel array)
+  """
+  bold_run = get_image_ids(spec.experiment)[spec.run]
+  ts = load_single_timeseries(None, bold_run, remove_mean, subject_dir, dtype)
+
+  if spec.conditions is None:
+    return ts.mean(axis=1)
+
+  conditions = [spec.conditions] if isinstance(spec.conditions, str) else spec.conditions
+  frames = [condition_frames(load_evs(None, spec.experiment, condition, subject_dir))[spec.run]
+            for condition in conditions]
+
+  if len(frames) == 1:
+    return condition_mean(ts, frames[0])
+  return condition_difference(ts, *frames)
+
+#Function: Score new subjects with a saved model
+
+@profile_stage
+def predict(model, subject_dirs, n_workers=None):
+  """
+  Score new subjects from their raw timeseries and EV files in one batch:
+  the features are computed per subject (in parallel with n_workers threads)
+  and the whole batch goes through the model at once.
+
+  Args:
+    model (str or dict) : Path of an artifact, or an artifact from load_model
+    subject_dirs (list of str) : Directories of the subjects to score
+    n_workers (None or int) : Threads loading the subjects, None uses N_WORKERS
+
+  Returns:
+    predictions (pd.Series): Predicted label of every subject directory
+  """
+  artifact = load_model(model) if isinstance(model, str) else model
+  spec, remove_mean = artifact['spec'], artifact['remove_mean']
+
+  # Features in the precision the model was trained with, whatever DTYPE is now
+  def features_of(subject_dir):
+    return subject_dir_features(subject_dir, spec, remove_mean, artifact['dtype'])
+
+  features = np.stack(map_subjects(features_of, subject_dirs, n_workers=n_workers))
+  return pd.Series(artifact['model'].predict(features), index=list(subject_dirs))
 
 #Visualising Brain Regions
 
-# This uses the nilearn package
-!pip install nilearn --quiet
-from nilearn import plotting, datasets
-
-# NMA provides an atlas 
-fname = f"{HCP_DIR}/atlas.npz"
-if not os.path.exists(fname):
-  !wget -qO $fname https://osf.io/j5kuc/download
-with np.load(fname) as dobj:
-  atlas = dict(**dobj)
-
-# Try both hemispheres (L->R and left->right)
-fsaverage = datasets.fetch_surf_fsaverage()
-surf_contrast = group_contrast[atlas["labels_L"]]
-plotting.view_surf(fsaverage['infl_left'],
-                   surf_contrast,
-                   vmax=20)
+#Function: Plot a per-region contrast on the inflated cortical surface
+
+def plot_surface(contrast, vmax=20):
+  """
+  Plot a per-region contrast on the inflated left hemisphere.
+
+  Args:
+    contrast (1D array): One value per region (parcel)
+    vmax (float) : Upper limit of the colour scale
+
+  Returns:
+    view : nilearn surface view
+  """
+  # This uses the nilearn package
+  from nilearn import plotting, datasets
+
+  # NMA provides an atlas
+  atlas = load_atlas()
+
+  # Try both hemispheres (L->R and left->right)
+  fsaverage = datasets.fetch_surf_fsaverage()
+  surf_contrast = contrast[atlas["labels_L"]]
+  return plotting.view_surf(fsaverage['infl_left'],
+                            surf_contrast,
+                            vmax=vmax)
+
+# Processing data
+
+def main(explore=False):
+  """
+  Run the whole analysis: features, gender split, model selection and
+  cross-validation.
+
+  Args:
+    explore (bool) : If True, also load the full BOLD data and print the
+      structure of every intermediate step
+  """
+  import matplotlib.pyplot as plt
+
+  #@title Figure settings
+  # %matplotlib inline
+  # %config InlineBackend.figure_format = 'retina'
+  try:
+    plt.style.use(resolve_data('mplstyle'))
+  except (FileNotFoundError, OSError):
+    pass  # Offline and never fetched: keep matplotlib's default style
+
+  ensure_dataset()
+
+  # Initialize data
+  experiment = "SOCIAL"
+  #pack_timeseries(experiment)  # <-- One-time packing step, later loads read the packed store
+
+  # Dividing subjects by gender.
+  female_indexes, male_indexes = get_random_indexes()
+
+  if explore:
+    ts_social  = get_timeseries(experiment)
+    bold_data  = get_BOLD(ts_social, experiment)
+
+    print("Original data . . . . . . . . . . . . . . . . . . . . . . . .\n")
+    print(f"bold_data has:   {len(bold_data)} subjects")
+    print(f"subject_0 has:   {len(bold_data[0])} runs")
+    print(f"s0, 1st_run has: {len(bold_data[0][0])} conditions")
+    print(f"s0, 2nd_run has: {len(bold_data[0][1])} conditions")
+    print(f"s0r0, 'mental':  {bold_data[0][0][0].shape} (ROIs, timepoints)")
+    print(f"s0r0, 'rnd':     {bold_data[0][0][1].shape}")
+    print(f"s0r1, 'mental':  {bold_data[0][1][0].shape}")
+    print(f"s0r1, 'rnd':     {bold_data[0][1][1].shape}\n\n")
+
+    #Data processed
+
+    # Removing excess of timepoints in 'condition' with bigger size, for both runs,
+    # and packing the result as a dense (subjects x runs x conditions x ROIs) tensor.
+    bold_tensor  = BOLDTensor.from_BOLD(remove_excess(bold_data, None))
+
+    print("After removing the excess . . . . . . . . . . . . . . . . . . .\n")
+    print(f"bold_tensor has:  {bold_tensor.shape} (subjects, runs, conditions, ROIs)")
+    print(f"s0r0, 'mental':   {len(bold_tensor.means[0][0][0])} regions averaged\n")
+
+    # Calculating BOLD signal's average for each region/subject, run 0
+    average_BOLD = bold_tensor.run(0)
+
+    print("BOLD signal's average for each region/subject, run 0 . . . . . .\n")
+    print(f"average_BOLD has: {len(average_BOLD)} subjects")
+    print(f"subject_0 has:    {len(average_BOLD[0])} conditions")
+    print(f"s0, 'mental' has: {len(average_BOLD[0][0])} regions")
+    print(f"s0c0, 1st region: {average_BOLD[0][0][0]}")
+    print(f"s0c0,last region: {average_BOLD[0][0][359]}\n")
+
+    F_AVERAGE_BOLD, M_AVERAGE_BOLD = divide_by_gender(average_BOLD, female_indexes, male_indexes)
+
+    print("Dividing subjects by gender, run 0 . . . . . . . . . . . . . . . .\n")
+    print("Female's average for each region/subject")
+    print(f"F_AVERAGE_BOLD has: {len(F_AVERAGE_BOLD)} subjects")
+    print(f"female_0 has:       {len(F_AVERAGE_BOLD[0])} conditions")
+    print(f"f0, 'mental' has:   {len(F_AVERAGE_BOLD[0][0])} regions")
+    print(f"f0c0,last region:   {F_AVERAGE_BOLD[0][0][359]}\n")
+
+    # Region's average for all subjects, by gender, run 0
+    F_AVERAGE_REGN = get_average_all_subjects(F_AVERAGE_BOLD)
+    M_AVERAGE_REGN = get_average_all_subjects(M_AVERAGE_BOLD)
+
+    print("Region's average for females, run 0 . . . . . . . . . . . . . . . .\n")
+    print(f"F_AVERAGE_REGN has: {len(F_AVERAGE_REGN)} conditions")
+    print(f"condition_0 has:    {len(F_AVERAGE_REGN[0])} averages for each region")
+    print(f"c0, last region:    {F_AVERAGE_REGN[0][359]}\n")
+
+    #F_AVERAGE_BOLD has the BOLD signal average for each female/region.
+
+    #F_AVERAGE_BOLD[females]                              <-- 150 females
+    #F_AVERAGE_BOLD[females][condition]                   <-- 2 conditions
+    #F_AVERAGE_BOLD[females][condition][average_region]   <-- 360 regions averaged
+
+    #Example
+
+    print("Female 1,   'mental', region 360 = ", F_AVERAGE_BOLD[0][0][359])
+    print("Female 150, 'rnd',    region 1   = ", F_AVERAGE_BOLD[149][1][0], "\n")
+
+    # Same for M_AVERAGE_BOLD:
+    # M_AVERAGE_BOLD[males][condition][average_region]
+
+  # In reduced precision (HCP_DTYPE=float32), check the classification first
+  if DTYPE != np.float64:
+    precision_report = validate_precision(experiment)
+    print(precision_report)
+    if not precision_report['unchanged']:
+      print(f"Warning: {DTYPE} changes {1 - precision_report['agreement']:.1%} of the predictions")
+
+  # Difference between conditions, run 0. Served from the feature cache when the
+  # same experiment/conditions/options were already computed.
+  MENTAL_RND_DIFF = cached_features(experiment, run=0)
+  F_MENTAL_RND_DIFF, M_MENTAL_RND_DIFF = divide_by_gender(MENTAL_RND_DIFF, female_indexes, male_indexes)
+
+  print(f"F_MENTAL_RND_DIFF has: {len(F_MENTAL_RND_DIFF)} subjects")                  #      understand the structure
+  print(f"female_0 has:          {len(F_MENTAL_RND_DIFF[0])} mental-rnd differences")
+
+  # Key lists from previous cell
+
+  #F_MENTAL_RND_DIFF has the 'mental' and 'rnd' difference (BOLD signal average per region/subject).
+  #F_MENTAL_RND_DIFF[subject]                    <-- 150 females
+  #F_MENTAL_RND_DIFF[subject][region_difference] <-- 360 regions averaged
+
+  #Example:
+
+  print("Female 1,   region 360 = ", F_MENTAL_RND_DIFF[0][359])
+  print("Female 150, region 1   = ", F_MENTAL_RND_DIFF[1][0], "\n")
+  print(type(F_MENTAL_RND_DIFF))
+  print(type(F_MENTAL_RND_DIFF[0]))
+  print(type(F_MENTAL_RND_DIFF[0][0]), "\n")
+
+  np_F_MENTAL_RND_DIFF = np.array(F_MENTAL_RND_DIFF)
+  np_M_MENTAL_RND_DIFF = np.array(M_MENTAL_RND_DIFF)
+
+  print(type(np_F_MENTAL_RND_DIFF))
+  print(type(np_F_MENTAL_RND_DIFF[0]))
+  print(type(np_F_MENTAL_RND_DIFF[0][0]))
+
+  # Same for M_MENTAL_RND_DIFF
+
+  #List with original genders
+
+  # From a previous cell, you have the lists female_indexes and male_indexes
+  # these two have the index for each female and male in the original list.
+  # Let's combine female_indexes and male_indexes so you have one list.
+  # NOTE: these indexes were selected randomly.
+
+  both_indexes = female_indexes + male_indexes
+  both_indexes.sort()
+  print(both_indexes)
+
+  # Now we're going to look for their gender.
+  current_subjects_gender = all_subjects_behavior(both_indexes, 'Gender', use_index=True)
+  print(current_subjects_gender)
+
+  # Model
+
+  #@title Libraries
+  from sklearn.preprocessing import Normalizer, StandardScaler
+  from sklearn.model_selection import train_test_split
+
+  # Prepare data
+
+  # Initial input data.
+
+  # X_vector should be the data (BOLD averages) of both genders.
+  BOLD_DATA = np.vstack((np_F_MENTAL_RND_DIFF, np_M_MENTAL_RND_DIFF))
+
+  # Y_vector should be the gender labels.
+  LABELS = np.array(['F'] * 150 + ['M'] * 150)
+
+  # Split the data into training and test sets
+
+  X_train, X_test, y_train, y_test = train_test_split(BOLD_DATA,
+                                                      LABELS,
+                                                      test_size = 0.1,
+                                                      random_state=0)
+  print(X_train.shape, X_test.shape)
+  print(y_train.shape, "\t  ", y_test.shape)
+
+  # Raw features, used by the cross-validation engine which preprocesses in-fold
+  X_train_raw, X_test_raw = X_train, X_test
+
+  # Scale and normalize the data (fitted on the training set only)
+
+  normal = Normalizer()
+  scaler = StandardScaler()
+
+  X_train = normal.fit_transform(X_train)
+  X_train = scaler.fit_transform(X_train)
+
+  X_test = normal.transform(X_test)
+  X_test = scaler.transform(X_test)
+
+  print(X_train.shape, X_test.shape)
+
+  # Frame with the training data and label
+
+  DF_TRAINING = pd.DataFrame(X_train)
+  DF_TRAINING['Label'] = y_train
+  print(DF_TRAINING.head())
+
+  # Identifying most relevant ROI for the experiment.
+
+  #Since we have more features (360 regions) than variables (300 subjects) we need to select the most relevant ones. We do this by computing the ANOVA F-value for the provided sample.
+
+  # Computing the ANOVA F-value once: the regions above every threshold
+  # are prefixes of the same F-value order
+  THRESHOLDS = [2, 3, 4, 5]
+  roi_index, f_sorted = regions_above(X_train, y_train, THRESHOLDS)
+
+  for t in THRESHOLDS:
+    roi_above = get_regions_names(roi_index[t])
+    print(f"There are {len(roi_above)} regions with " +
+          f"a F-value higher than {t}:\n{roi_above}\n")
+
+  # Finding the best threshold for our data, in one cross-validated pass
+
+  sweep = threshold_sweep(X_train_raw, y_train, THRESHOLDS, classifier='et')
+  print(sweep)
+  best_threshold = sweep['mean'].idxmax()
+
+  # Finding the best model for the regions above the best threshold
+
+  leaderboard = compare_models(X_train_raw, y_train, k=len(roi_index[best_threshold]),
+                               time_budget=600)
+  print(leaderboard)
+
+  # Cross-validation to check model's accuracy
+
+  # Remove less relevant features from train and test data **(run just once)
+
+  #delete_columns = [i for i in range(360) if i not in roi_index[best_threshold]]
+  #X_train = np.delete(X_train, delete_columns, 1)
+  #X_test  = np.delete(X_test,  delete_columns, 1)
+
+  # Cross-validation: Extra Trees Classifier, with scaling and the selection of
+  # the regions with the highest F-values (as many as above the best threshold)
+  # inside each fold
+
+  scores = cross_validate_model(X_train_raw, y_train, 'et', k=len(roi_index[best_threshold]),
+                                n_splits=5, n_repeats=10)
+
+  print(scores.mean(), scores.std())
+
+  # Test the data
+
+  model = make_pipeline('et', k=len(roi_index[best_threshold])).fit(normal.transform(X_train_raw), y_train)
+  print(model.score(normal.transform(X_test_raw), y_test))
+
+  # Save the fitted model, to score new subjects with predict()
+  save_model(f"{HCP_DIR}/models/gender_{experiment.lower()}.joblib", model, experiment)
+
+  # Bootstrap: the same analysis over many balanced subsamples of all subjects
+
+  boot_scores, (low, high) = bootstrap_scores(MENTAL_RND_DIFF, n_resamples=100,
+                                              k=len(roi_index[best_threshold]))
+  print(f"Accuracy over {len(boot_scores)} subsamples: {boot_scores.mean():.3f} " +
+        f"(95% CI {low:.3f} - {high:.3f})")
+
+  # Permutation test
+
+  # Null distribution of the accuracy, with the gender labels shuffled
+  score, null_scores, pvalue = permutation_test(X_train_raw, y_train, 'ridge',
+                                                n_permutations=10000)
+  print(f"Accuracy: {score:.3f}, p-value: {pvalue:.4f}")
+  plot_null_distribution(score, null_scores, pvalue)
+
+  # Incremental training: the training subjects are added in batches, as new
+  # subjects would be, and the model is refitted from the running statistics
+
+  online = IncrementalModel(k=len(roi_index[best_threshold]))
+  for batch in np.array_split(np.arange(len(y_train)), 3):
+    online.update(X_train_raw[batch], y_train[batch]).fit()
+  print(online.score(X_test_raw, y_test))
+
+  #Visualising Brain Regions
+
+  # Female minus male average of the mental-rnd differences
+  group_contrast = np_F_MENTAL_RND_DIFF.mean(axis=0) - np_M_MENTAL_RND_DIFF.mean(axis=0)
+  plot_surface(group_contrast)
+
+  # Per-stage profile of the run (HCP_PROFILE=1)
+  if PROFILE:
+    print_profile()
+    profile_report(PROFILE_REPORT)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""Stage-level benchmarks of the gender prediction pipeline.
+
+Writes a synthetic cohort with the HCP layout
+(subjects/<i>/timeseries/bold*.npy and subjects/<i>/EVs/<task>/<condition>.txt),
+runs every stage of the analysis on it, and saves the time and peak memory
+of each stage to JSON. Nothing is downloaded: it runs without the HCP data.
+
+Example:
+  python benchmark.py --subjects 1000 --parcels 360 --timepoints 274 --out bench.json
+  python benchmark.py --subjects 1000 --baseline bench.json
+"""
+
+# import libraries
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+
+import Gender_Prediction_from_BOLD_signals as gp
+
+#Function: Write a synthetic cohort with the HCP layout
+
+def make_synthetic_cohort(root, n_subjects=339, n_parcels=gp.N_PARCELS, n_timepoints=274,
+                          experiment="SOCIAL", conditions=None, n_trials=5, effect=0.2,
+                          seed=0):
+  """
+  Write a synthetic cohort with the HCP layout: one timeseries file per
+  subject/run and one EV file per subject/run/condition. Half of the subjects
+  get a small condition effect in the first parcels, so the classifiers
+  have something to find.
+
+  Existing subjects are kept, so growing a cohort only writes the new ones.
+  Every subject has its own random stream, so a grown cohort holds the same
+  data as one written in one go.
+
+  Args:
+    root (str) : Directory standing for HCP_DIR
+    n_subjects (int) : Number of subjects
+    n_parcels (int) : Number of parcels of every timeseries
+    n_timepoints (int) : Frames of every run
+    experiment (str) : Name of experiment whose runs are written
+    conditions (None or list of str) : Conditions with an EV file, None for CONDITIONS
+    n_trials (int) : Blocks per condition and run
+    effect (float) : Size of the condition effect of the first group
+    seed (int) : Seed of the generator
+
+  Returns:
+    labels (n_subjects array): 'F'/'M' group of every subject
+  """
+  if conditions is None:
+    conditions = gp.CONDITIONS
+
+  labels = np.where(np.random.default_rng(seed).random(n_subjects) < 0.5, 'F', 'M')
+
+  # Trials of every condition take turns, in blocks of equal length
+  block = n_timepoints // (len(conditions) * n_trials + 1)
+  duration = block * gp.TR
+
+  for subject in range(n_subjects):
+    subject_dir = f"{root}/subjects/{subject}"
+    if os.path.exists(f"{subject_dir}/done"):
+      continue
+    os.makedirs(f"{subject_dir}/timeseries", exist_ok=True)
+    rng = np.random.default_rng([seed, subject])
+
+    for bold_run in gp.get_image_ids(experiment):
+      ts = rng.standard_normal((n_parcels, n_timepoints))
+      ev_dir = f"{subject_dir}/EVs/{gp.BOLD_NAMES[bold_run - 1]}"
+      os.makedirs(ev_dir, exist_ok=True)
+
+      for c, condition in enumerate(conditions):
+        onsets = (np.arange(n_trials) * len(conditions) + c) * block
+        if c == 0 and labels[subject] == 'F':
+          for start in onsets:
+            ts[:n_parcels // 10, start:start + block] += effect
+
+        ev = np.column_stack((onsets * gp.TR, np.full(n_trials, duration), np.ones(n_trials)))
+        np.savetxt(f"{ev_dir}/{condition}.txt", ev, fmt="%.2f")
+
+      np.save(f"{subject_dir}/timeseries/bold{bold_run}_Atlas_MSMAll_Glasser360Cortical.npy", ts)
+
+    open(f"{subject_dir}/done", "w").close()
+
+  return labels
+
+#Function: Point the analysis module at a cohort
+
+def use_cohort(root, n_subjects, n_parcels=gp.N_PARCELS):
+  gp.HCP_DIR           = root
+  gp.PACKED_DIR        = f"{root}/packed"
+  gp.FEATURE_CACHE_DIR = f"{root}/cache"
+  gp.CONNECTIVITY_DIR  = f"{root}/connectivity"
+  gp.N_SUBJECTS        = n_subjects
+  gp.N_PARCELS         = n_parcels
+  gp.clear_frame_index()
+  gp._PACKED_STORES.clear()
+
+#Function: Time and memory-profile one stage
+
+def measure(results, stage, func, *args, **kwargs):
+  """
+  Run one stage, recording its wall time and its peak traced memory (NumPy
+  allocations included) in results.
+
+  Returns:
+    output : What func returned, for the next stages
+  """
+  tracemalloc.start()
+  tic = time.perf_counter()
+  output = func(*args, **kwargs)
+  seconds = time.perf_counter() - tic
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  results[stage] = {'seconds': seconds, 'peak_bytes': peak}
+  print(f"{stage:<28} {seconds:10.3f} s {peak / 1024**2:10.1f} MiB")
+  return output
+
+#Function: Run every stage on a cohort
+
+def run_benchmarks(root, labels, n_parcels=gp.N_PARCELS, experiment="SOCIAL",
+                   classifiers=('et', 'lr'), k=40):
+  """
+  Run the stages of the analysis one after the other on a cohort.
+
+  Args:
+    root (str) : Cohort written by make_synthetic_cohort
+    labels (n_subjects array): Labels of the subjects
+    n_parcels (int) : Number of parcels of the cohort
+    experiment (str) : Name of experiment
+    classifiers (list of str): Short names for make_classifier
+    k (int) : Regions kept by the ANOVA F-value
+
+  Returns:
+    results (dict): stage -> {'seconds', 'peak_bytes'}
+  """
+  from sklearn.feature_selection import f_classif
+  from sklearn.preprocessing import Normalizer
+
+  use_cohort(root, len(labels), n_parcels)
+
+  # Cohorts are reused: drop the packed store and the feature cache of an
+  # earlier run, so the unpacked stages read the per-run files every time
+  shutil.rmtree(gp.PACKED_DIR, ignore_errors=True)
+  shutil.rmtree(gp.FEATURE_CACHE_DIR, ignore_errors=True)
+  gp._PACKED_STORES.clear()
+
+  bold_run = gp.get_image_ids(experiment)[0]
+  results = {}
+
+  measure(results, 'load_single_timeseries',
+          lambda: [gp.load_single_timeseries(s, bold_run) for s in range(gp.N_SUBJECTS)])
+  timeseries = measure(results, 'get_timeseries', gp.get_timeseries, experiment)
+  measure(results, 'build_frame_index', gp.build_frame_index, experiment)
+  bold = measure(results, 'select_frames (get_BOLD)', gp.get_BOLD, timeseries, experiment)
+  del timeseries
+  reduced = measure(results, 'remove_excess', gp.remove_excess, bold, 0)
+  del bold
+  averages = measure(results, 'get_average_by_region', gp.get_average_by_region, reduced)
+  del reduced
+  measure(results, 'get_difference', gp.get_difference, averages)
+  del averages
+
+  features = measure(results, 'get_features (streamed)', gp.get_features, experiment, 0)
+  measure(results, 'pack_timeseries', gp.pack_timeseries, experiment, True)
+  measure(results, 'get_features (packed)', gp.get_features, experiment, 0)
+
+  X = Normalizer().fit_transform(features)
+  measure(results, 'f_classif', f_classif, X, labels)
+  # Folds run in this process (n_jobs=1): tracemalloc does not see subprocesses
+  for name in classifiers:
+    measure(results, f'cross_validate_model ({name})', gp.cross_validate_model,
+            features, labels, name, k=min(k, X.shape[1]), n_jobs=1)
+
+  return results
+
+#Function: Compare results with a baseline run
+
+def compare(results, baseline, tolerance=0.2, min_seconds=0.05):
+  """
+  Print the stages that got slower than a baseline by more than tolerance,
+  and by more than min_seconds: millisecond stages vary by more than any
+  sensible tolerance from run to run.
+
+  Returns:
+    regressions (list of str): Names of the slower stages
+  """
+  regressions = []
+  for stage, result in results.items():
+    if stage not in baseline:
+      continue
+    ratio = result['seconds'] / max(baseline[stage]['seconds'], 1e-9)
+    slower = result['seconds'] - baseline[stage]['seconds']
+    if ratio > 1 + tolerance and slower > min_seconds:
+      regressions.append(stage)
+      print(f"Regression: {stage} is {ratio:.2f}x slower than the baseline")
+  return regressions
+
+#Function: Command-line entry point
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--root', default='./hcp_benchmark', help="Directory of the synthetic cohort")
+  parser.add_argument('--subjects', type=int, default=339)
+  parser.add_argument('--parcels', type=int, default=gp.N_PARCELS)
+  parser.add_argument('--timepoints', type=int, default=274)
+  parser.add_argument('--workers', type=int, default=None, help="Sets N_WORKERS")
+  parser.add_argument('--classifiers', default='et,lr')
+  parser.add_argument('--out', default='benchmark.json')
+  parser.add_argument('--baseline', default=None, help="JSON of an earlier run to compare with")
+  parser.add_argument('--tolerance', type=float, default=0.2)
+  parser.add_argument('--min-seconds', type=float, default=0.05,
+                      help="Slowdowns smaller than this are not regressions")
+  args = parser.parse_args(argv)
+
+  # Read the baseline first: it may be the file this run overwrites
+  baseline = None
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)['results']
+
+  # Every run shape gets its own directory; runs with more subjects grow it
+  root = f"{args.root}/{args.parcels}x{args.timepoints}"
+  labels = make_synthetic_cohort(root, args.subjects, args.parcels, args.timepoints)
+
+  gp.N_WORKERS = args.workers
+  results = run_benchmarks(root, labels, args.parcels, classifiers=args.classifiers.split(','))
+
+  report = {'config':      vars(args),
+            'environment': {'python': platform.python_version(),
+                            'numpy':  np.__version__,
+                            'cpus':   os.cpu_count()},
+            'results':     results}
+  with open(args.out, 'w') as f:
+    json.dump(report, f, indent=2)
+
+  if baseline is not None and compare(results, baseline, args.tolerance, args.min_seconds):
+    return 1
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())